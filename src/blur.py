@@ -0,0 +1,120 @@
+from math import ceil
+
+from multiprocessing.pool import ThreadPool
+
+from numpy import arange, asarray, exp, float32, iinfo, pad, rint, zeros
+
+from cache import AssetCache, content_hash
+from settings import BLUR_WORKERS, GAUSSIAN_BLURS
+from tools import load_pixels
+
+
+# ------------------------------------------------------------------
+# HANDLE GAUSSIAN BLUR
+# ------------------------------------------------------------------
+
+def gaussian_kernel(radius):
+    """
+    Get the 1D Gaussian kernel of standard deviation radius, as used by
+    PIL for the radius of its GaussianBlur, cut off at 3 radii and
+    normalized so that blurring keeps the mean value of the image
+
+    >>> kernel = gaussian_kernel(1)
+    >>> len(kernel), round(kernel.sum(), 6), kernel.argmax()
+    (7, 1.0, 3)
+    """
+    extent = int(ceil(3 * radius))
+    taps = arange(-extent, extent + 1, dtype=float32)
+    kernel = exp(-0.5 * (taps / radius) ** 2)
+    return kernel / kernel.sum()
+
+
+def blur(pixels, radius):
+    """
+    Blur the pixels, an array as loaded by tools.load_pixels, with a
+    Gaussian of the radius, returning an array of the same type
+
+    The 2D Gaussian is separable, so it is applied as the 1D kernel along
+    the columns and then along the rows, taking 2 * (6 * radius + 1)
+    multiply-adds per pixel instead of (6 * radius + 1) ** 2. The edges
+    wrap around, as the textures repeat
+
+    >>> from numpy import uint8
+    >>> pixels = zeros((8, 8), uint8)
+    >>> pixels[4, 4] = 255
+    >>> blurred = blur(pixels, 1)
+    >>> blurred.dtype.name, blurred[4].tolist()
+    ('uint8', [0, 0, 5, 25, 41, 25, 5, 0])
+    """
+    pixels = asarray(pixels)
+    kernel = gaussian_kernel(radius)
+    extent = len(kernel) // 2
+    result = pixels.astype(float32)
+    for axis in (0, 1):
+        # Pad the axis with the pixels wrapped around from the other edge,
+        # so that each tap is a slice of the padded array
+        width = [(0, 0)] * result.ndim
+        width[axis] = (extent, extent)
+        padded = pad(result, width, 'wrap')
+        size = result.shape[axis]
+        result = zeros(result.shape, float32)
+        for tap, weight in enumerate(kernel):
+            index = [slice(None)] * result.ndim
+            index[axis] = slice(tap, tap + size)
+            result += weight * padded[tuple(index)]
+
+    if pixels.dtype.kind in 'ui':
+        limits = iinfo(pixels.dtype)
+        return rint(result).clip(limits.min, limits.max).astype(pixels.dtype)
+    return result.astype(pixels.dtype)
+
+
+def blur_all(pixels, radii=GAUSSIAN_BLURS, workers=BLUR_WORKERS):
+    """
+    Blur the pixels with each of radii, in parallel on a pool of threads,
+    as numpy releases the GIL while it works through the arrays
+    """
+    pool = ThreadPool(max(1, min(workers, len(radii))))
+    try:
+        return pool.map(lambda radius: blur(pixels, radius), radii)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_blurred(sources):
+    """
+    Load the blurred image for sources, the filename of an image and the
+    radius of the blur, from the asset cache or otherwise blurring it and
+    storing it into the cache
+    """
+    filename, radius = sources
+    return load_blur_levels(filename, [radius])[0]
+
+
+def load_blur_levels(filename, radii=GAUSSIAN_BLURS):
+    """
+    Load the image blurred with each of radii, blurring with the radii
+    missing from the asset cache in parallel and storing them into the
+    cache under the hash of the image
+
+    The image is only decoded if any of the radii are missing
+    """
+    cache = AssetCache('blur')
+    image_hash = content_hash(filename)
+    keys = [cache.key(image_hash, 'gaussian', radius) for radius in radii]
+
+    levels = [cache.load(key) for key in keys]
+    missing = [i for i, arrays in enumerate(levels) if arrays is None]
+    if missing:
+        blurred = blur_all(load_pixels(filename),
+                           [radii[i] for i in missing])
+        for i, pixels in zip(missing, blurred):
+            cache.save(keys[i], {'blurred': pixels})
+            levels[i] = {'blurred': pixels}
+    return [arrays['blurred'] for arrays in levels]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,79 +1,189 @@
+from ctypes import c_void_p
+
 from OpenGL.GL import (
-                       glBindBuffer, glBufferData,
+                       glBindBuffer, glBufferData, glBufferSubData,
                        glDeleteBuffers,
                        glColorPointer, glEdgeFlagPointer, glIndexPointer,
                        glNormalPointer, glTexCoordPointer, glVertexPointer,
-                       glEnableVertexAttribArray, glVertexAttribPointer,
-                       GL_FALSE, GL_STATIC_DRAW
+                       glEnableVertexAttribArray, glDisableVertexAttribArray,
+                       glVertexAttribPointer, glVertexAttrib4f,
+                       glVertexAttribDivisor,
+                       glDisableClientState, glNormal3f,
+                       GL_FALSE, GL_TRUE, GL_NORMAL_ARRAY, GL_STATIC_DRAW,
+                       GL_FLOAT, GL_HALF_FLOAT, GL_SHORT, GL_UNSIGNED_SHORT,
+                       GL_INT_2_10_10_10_REV
 )
 from OpenGL.arrays import ArrayDatatype as ADT
 
 from pyglet.gl import (
                        glGenBuffers,
-                       GL_ARRAY_BUFFER,
+                       GL_ARRAY_BUFFER, GL_ELEMENT_ARRAY_BUFFER,
                        GLuint
 )
 
 
+# OpenGL type in which the attributes stored as each numpy type are
+# read, and whether they are normalized onto a 0.0 - 1.0 or -1.0 - 1.0
+# scale. int32 is only used for normals packed by mesh.pack_normals
+FORMATS = {
+           'float32': (GL_FLOAT, GL_FALSE),
+           'float16': (GL_HALF_FLOAT, GL_FALSE),
+           'int16': (GL_SHORT, GL_TRUE),
+           'uint16': (GL_UNSIGNED_SHORT, GL_TRUE),
+           'int32': (GL_INT_2_10_10_10_REV, GL_TRUE)
+}
+
+
 class VertexBuffer(object):
     """
     Handle VertexBufferObjects of all types
     """
 
-    def __init__(self, data, usage=GL_STATIC_DRAW):
+    target = GL_ARRAY_BUFFER
+
+    def __init__(self, data, usage=GL_STATIC_DRAW, divisor=0):
         """
         Initiate the vertex buffer object on the CPU
+
+        If data is a structured array, the attributes are interleaved:
+        the stride is the size of one record and the offset of each
+        attribute is recorded by its field name
+
+        If divisor is set, the attributes advance once per divisor
+        instances instead of once per vertex
         """
+        self.divisor = divisor
+        self.dtype = data.dtype
+        # Number of components of each vertex, if not interleaved
+        self.components = data.shape[1] if data.ndim > 1 else 1
+        self.stride = 0
+        self.offsets = {}
+        if data.dtype.names:
+            self.stride = data.dtype.itemsize
+            for name in data.dtype.names:
+                self.offsets[name] = data.dtype.fields[name][1]
+
         self.buffer = GLuint(0)
         glGenBuffers(1, self.buffer)
         self.buffer = self.buffer.value
 
-        glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
-        glBufferData(GL_ARRAY_BUFFER, ADT.arrayByteCount(data),
+        glBindBuffer(self.target, self.buffer)
+        glBufferData(self.target, ADT.arrayByteCount(data),
                      ADT.voidDataPointer(data), usage)
 
     def __del__(self):
         glDeleteBuffers(1, GLuint(self.buffer))
 
+    def update(self, data):
+        """
+        Replace the data held by the vertex buffer object with data of
+        the same size, as for a buffer created with GL_DYNAMIC_DRAW
+        """
+        glBindBuffer(self.target, self.buffer)
+        glBufferSubData(self.target, 0, ADT.arrayByteCount(data),
+                        ADT.voidDataPointer(data))
+
 # ------------------------------------------------------------------
 # BINDING MODULES
 # ------------------------------------------------------------------
 
     def bind(self):
-        glBindBuffer(GL_ARRAY_BUFFER, self.buffer)
+        glBindBuffer(self.target, self.buffer)
 
     def unbind(self):
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindBuffer(self.target, 0)
 
-    def bind_attribute(self, attribute, size, var_type, stride=0):
+    def format(self, name=None):
+        """
+        Get the number of components and the OpenGL type of the
+        attribute stored under name, along with whether it is normalized
+        """
+        dtype = self.dtype
+        components = self.components
+        if dtype.names:
+            dtype = dtype.fields[name][0]
+            components = dtype.shape[0] if dtype.shape else 1
+
+        var_type, normalized = FORMATS[dtype.base.name]
+        # Packed normals are read as 4 components from a single value
+        if var_type == GL_INT_2_10_10_10_REV:
+            components = 4
+        return components, var_type, normalized
+
+    def bind_attribute(self, attribute, size, var_type, stride=0, offset=0,
+                       normalized=GL_FALSE):
         self.bind()
         glEnableVertexAttribArray(attribute)
-        glVertexAttribPointer(attribute, size, var_type, GL_FALSE, stride,
-                              None)
+        glVertexAttribPointer(attribute, size, var_type, normalized, stride,
+                              pointer(offset))
+        glVertexAttribDivisor(attribute, self.divisor)
 
-    def bind_colors(self, size, var_type, stride=0):
+    def bind_colors(self, size, var_type, stride=0, offset=0):
         self.bind()
-        glColorPointer(size, var_type, stride, None)
+        glColorPointer(size, var_type, stride, pointer(offset))
 
-    def bind_edgeflags(self, stride=0):
+    def bind_edgeflags(self, stride=0, offset=0):
         self.bind()
-        glEdgeFlagPointer(stride, None)
+        glEdgeFlagPointer(stride, pointer(offset))
 
-    def bind_indexes(self, var_type, stride=0):
+    def bind_indexes(self, var_type, stride=0, offset=0):
         self.bind()
-        glIndexPointer(var_type, stride, None)
+        glIndexPointer(var_type, stride, pointer(offset))
 
-    def bind_normals(self, var_type, stride=0):
+    def bind_normals(self, var_type, stride=0, offset=0):
         self.bind()
-        glNormalPointer(var_type, stride, None)
+        glNormalPointer(var_type, stride, pointer(offset))
 
-    def bind_texcoords(self, size, var_type, stride=0):
+    def bind_texcoords(self, size, var_type, stride=0, offset=0):
         self.bind()
-        glTexCoordPointer(size, var_type, stride, None)
+        glTexCoordPointer(size, var_type, stride, pointer(offset))
 
-    def bind_vertices(self, size, var_type, stride=0):
+    def bind_vertices(self, size, var_type, stride=0, offset=0):
         self.bind()
-        glVertexPointer(size, var_type, stride, None)
+        glVertexPointer(size, var_type, stride, pointer(offset))
+
+
+class ElementBuffer(VertexBuffer):
+    """
+    ElementBuffer, subclass of VertexBuffer, holds the indices into the
+    VertexBufferObjects used by glDrawElements
+    """
+
+    target = GL_ELEMENT_ARRAY_BUFFER
+
+
+# ------------------------------------------------------------------
+# HELPER FUNCTIONS
+# ------------------------------------------------------------------
+
+def pointer(offset):
+    """
+    Convert a byte offset into the bound buffer into the pointer
+    expected by the gl*Pointer functions
+    """
+    if offset:
+        return c_void_p(offset)
+    return None
+
+
+def set_constant_attribute(attribute, values):
+    """
+    Set a vertex attribute that is the same for every vertex as a
+    generic vertex attribute, instead of reading it from a buffer
+    """
+    glDisableVertexAttribArray(attribute)
+    # Pad the values in the same way OpenGL pads a partial attribute
+    values = list(values) + [0.0, 0.0, 0.0, 1.0][len(values):]
+    glVertexAttrib4f(attribute, *values)
+
+
+def set_constant_normal(values):
+    """
+    Set a normal that is the same for every vertex, instead of reading
+    it from a buffer with glNormalPointer
+    """
+    glDisableClientState(GL_NORMAL_ARRAY)
+    glNormal3f(*values)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,222 @@
+from json import dumps, loads
+
+from numpy import dtype, memmap
+
+from glob import glob
+
+from os import close, remove, rename, stat
+from os.path import dirname, exists, normpath
+
+from struct import calcsize, pack, unpack
+
+from tempfile import mkstemp
+
+from cache import content_hash
+from settings import ENABLE_BUNDLE, STIMULI_BUNDLE
+
+
+# The bundle starts with MAGIC, VERSION and the length of the header,
+# the header is the index of the maps as JSON, and the pixels of each
+# map follow, each starting at an offset aligned to ALIGNMENT
+MAGIC = 'SLRBNDL\0'
+VERSION = 1
+PREFIX = '<8sII'
+# Align the maps to the pages of memory, so that each is mapped on its
+# own pages
+ALIGNMENT = 4096
+
+
+class Bundle(object):
+    """
+    Read the pixels of the maps packed into a bundle by pack_bundle.py,
+    memory-mapped, so that they are neither decoded nor copied, and the
+    processes reading the same bundle share its pages
+
+    >>> from numpy import arange, uint8
+    >>> from os import remove
+    >>> from tempfile import mktemp
+    >>> path = mktemp()
+    >>> write_bundle(path, [('a.png', 'hash', arange(6, dtype=uint8))])
+    >>> latest_bundle(path) == path + '.1'
+    True
+    >>> bundle = Bundle(latest_bundle(path))
+    >>> bundle.entries['a.png']['offset']
+    4096
+    >>> bundle.get('a.png', verify=False).tolist()
+    [0, 1, 2, 3, 4, 5]
+    >>> del bundle
+    >>> remove(path + '.1')
+    """
+
+    def __init__(self, path, *args, **kwargs):
+        """
+        Map the bundle into memory and read the index of its maps
+        """
+        self.data = memmap(path, mode='r')
+        size = calcsize(PREFIX)
+        magic, version, length = unpack(PREFIX, self.data[:size].tostring())
+        if magic != MAGIC or version != VERSION:
+            raise IOError('%s is not a bundle of version %d' %
+                          (path, VERSION))
+        self.entries = loads(self.data[size:size + length].tostring())
+        # Source files found to have changed since they were packed
+        self.stale = set()
+        # Modification time and size of the source files found to be as
+        # they were packed, so that they are only hashed again once
+        # either changes
+        self.verified = {}
+
+    def get(self, filename, verify=True):
+        """
+        Get the pixels of the map packed from filename, as an array
+        mapped onto the bundle, or None if it has not been packed
+
+        If verify is set, None is also returned if the file has changed
+        since it was packed, so that it is decoded instead
+        """
+        filename = normpath(filename)
+        entry = self.entries.get(filename)
+        if entry is None or filename in self.stale:
+            return None
+        if verify and not self.__verify(filename, entry['hash']):
+            self.stale.add(filename)
+            return None
+
+        kind = dtype(entry['dtype'])
+        size = kind.itemsize
+        for length in entry['shape']:
+            size *= length
+        pixels = self.data[entry['offset']:entry['offset'] + size]
+        return pixels.view(kind).reshape(entry['shape'])
+
+    def __verify(self, filename, digest):
+        """
+        Check that the file has not changed since it was packed with the
+        hash digest, only hashing it if its modification time or size
+        has changed since it was last checked
+        """
+        status = stat(filename)
+        status = (status.st_mtime, status.st_size)
+        if self.verified.get(filename) == status:
+            return True
+        if content_hash(filename) != digest:
+            return False
+        self.verified[filename] = status
+        return True
+
+
+# ------------------------------------------------------------------
+# HELPER FUNCTIONS
+# ------------------------------------------------------------------
+
+def write_bundle(path, maps):
+    """
+    Write the bundle of maps, a list of the source filename, the hash
+    of its content and its pixels as an array, for each map
+
+    The bundle is written as the next version of the bundle at path, see
+    latest_bundle, as the version mapped by a running experiment can be
+    neither replaced nor removed on Windows
+    """
+    # Offsets of the maps from the end of the header
+    offsets = []
+    offset = 0
+    for filename, digest, pixels in maps:
+        offsets.append(offset)
+        offset = align(offset + pixels.nbytes)
+
+    # The maps start after the header, which holds their offsets, so
+    # grow the start until the header fits in front of the maps
+    start = 0
+    while True:
+        entries = {}
+        for (filename, digest, pixels), offset in zip(maps, offsets):
+            entries[normpath(filename)] = {'shape': list(pixels.shape),
+                                           'dtype': pixels.dtype.name,
+                                           'hash': digest,
+                                           'offset': start + offset}
+        header = dumps(entries, sort_keys=True)
+        if align(calcsize(PREFIX) + len(header)) <= start:
+            break
+        start = align(calcsize(PREFIX) + len(header))
+
+    # Write into a temporary file first, so that an experiment launched
+    # at the same time never maps a half written bundle
+    handle, temp = mkstemp(dir=dirname(path) or '.')
+    close(handle)
+    with open(temp, 'wb') as f:
+        f.write(pack(PREFIX, MAGIC, VERSION, len(header)))
+        f.write(header)
+        for (filename, digest, pixels), offset in zip(maps, offsets):
+            f.seek(start + offset)
+            f.write(pixels.tostring())
+
+    # Renaming onto a name that is not taken is atomic on every platform
+    versions = bundle_versions(path)
+    version = versions[-1] + 1 if versions else 1
+    while True:
+        try:
+            rename(temp, '%s.%d' % (path, version))
+            break
+        except OSError:
+            if not exists('%s.%d' % (path, version)):
+                raise
+            # Taken by another packer in the meantime
+            version += 1
+
+    # Processes that have an older bundle mapped keep reading it, and on
+    # Windows it is only removed by a later packing once it is unmapped
+    for older in versions:
+        try:
+            remove('%s.%d' % (path, older))
+        except OSError:
+            pass
+
+
+def align(offset):
+    """
+    Round offset up to the next multiple of ALIGNMENT
+
+    >>> align(0), align(1), align(4096)
+    (0, 4096, 4096)
+    """
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def bundle_versions(path):
+    """
+    Get the versions of the bundle at path that have been written, from
+    the oldest to the latest
+    """
+    versions = []
+    for filename in glob(path + '.*'):
+        suffix = filename[len(path) + 1:]
+        if suffix.isdigit():
+            versions.append(int(suffix))
+    return sorted(versions)
+
+
+def latest_bundle(path=STIMULI_BUNDLE):
+    """
+    Get the filename of the latest version of the bundle at path, or None
+    if it has not been packed
+    """
+    versions = bundle_versions(path)
+    if not versions:
+        return None
+    return '%s.%d' % (path, versions[-1])
+
+
+def open_bundle(path=STIMULI_BUNDLE):
+    """
+    Open the latest version of the bundle at path, or return None if it
+    has not been packed or bundles are disabled by ENABLE_BUNDLE
+    """
+    if not ENABLE_BUNDLE or latest_bundle(path) is None:
+        return None
+    return Bundle(latest_bundle(path))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,103 @@
+from hashlib import sha1
+
+from numpy import load, save
+
+from os import listdir, makedirs, rename
+from os.path import exists, join
+
+from shutil import rmtree
+
+from tempfile import mkdtemp
+
+from settings import CACHE_DIR, ENABLE_CACHE
+
+
+# Increase this whenever the layout of the cached arrays changes, so
+# that the arrays cached by older versions are no longer used
+CACHE_VERSION = 2
+
+
+def content_hash(filename):
+    """
+    Get the hash of the content of the file, so that the assets
+    generated from it are generated again whenever it changes
+    """
+    with open(filename, 'rb') as f:
+        return sha1(f.read()).hexdigest()
+
+
+class AssetCache(object):
+    """
+    Store generated arrays on disk as ".npy" files, under a key made from
+    all the parameters used to generate them
+
+    The arrays are loaded back memory-mapped, so they are read straight
+    from the page cache without being copied or generated again
+    """
+
+    def __init__(self, kind, *args, **kwargs):
+        """
+        Set the directory in which the arrays of this kind are stored
+        """
+        self.directory = join(CACHE_DIR, kind)
+
+    def key(self, *params):
+        """
+        Make the key for the arrays generated from params
+
+        >>> len(AssetCache('mesh').key(512, 512, 1))
+        40
+        """
+        return sha1(repr((CACHE_VERSION,) + params)).hexdigest()
+
+    def load(self, key):
+        """
+        Load the arrays stored under key, memory-mapped
+        Return None if they have not been stored yet
+        """
+        path = join(self.directory, key)
+        if not ENABLE_CACHE or not exists(path):
+            return None
+
+        arrays = {}
+        for filename in listdir(path):
+            if filename.endswith('.npy'):
+                arrays[filename[:-4]] = load(join(path, filename),
+                                             mmap_mode='r')
+        return arrays
+
+    def save(self, key, arrays):
+        """
+        Store the arrays under key, each under its own name
+        """
+        path = join(self.directory, key)
+        if not ENABLE_CACHE or exists(path):
+            return
+
+        if not exists(self.directory):
+            try:
+                makedirs(self.directory)
+            except OSError:
+                # Made by another thread or process in the meantime
+                pass
+
+        # Write into a temporary directory of its own first, so that an
+        # experiment launched at the same time never loads a half written
+        # entry, and no other thread writes into it
+        temp = mkdtemp(dir=self.directory)
+        try:
+            for name, data in arrays.items():
+                save(join(temp, name + '.npy'), data)
+            rename(temp, path)
+        except OSError:
+            # Another thread or process stored the same entry in the
+            # meantime
+            pass
+        finally:
+            # Left behind only if it was not renamed into place
+            rmtree(temp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
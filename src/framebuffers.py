@@ -0,0 +1,75 @@
+from OpenGL.GL import (
+                       glBindFramebuffer, glCheckFramebufferStatus,
+                       glDeleteFramebuffers, glFramebufferTexture2D,
+                       glTexImage2D, glViewport,
+                       GL_COLOR_ATTACHMENT0, GL_FRAMEBUFFER,
+                       GL_FRAMEBUFFER_COMPLETE, GL_RGBA, GL_RGBA16,
+                       GL_TEXTURE_2D, GL_UNSIGNED_SHORT
+)
+
+from pyglet.gl import glDeleteTextures, glGenFramebuffers, GLuint
+
+from textures import generate
+
+
+class FrameBufferError(Exception):
+    pass
+
+
+class FrameBuffer(object):
+    """
+    Handle a Frame Buffer Object drawing into a texture of its own, so
+    that what is drawn into it is sampled as any other texture
+    """
+
+    def __init__(self, width, height, internal_format=GL_RGBA16):
+        """
+        Create the texture drawn into, bound to the active texture unit,
+        and attach it to the frame buffer object
+
+        The texture is stored in 16 bits, so that the heights between
+        the 256 levels of 8-bit heightmaps are kept when they are blurred
+        """
+        self.width = width
+        self.height = height
+
+        self.texture = generate(GL_TEXTURE_2D)
+        glTexImage2D(GL_TEXTURE_2D, 0, internal_format, width, height, 0,
+                     GL_RGBA, GL_UNSIGNED_SHORT, None)
+
+        self.buffer = GLuint(0)
+        glGenFramebuffers(1, self.buffer)
+        self.buffer = self.buffer.value
+
+        glBindFramebuffer(GL_FRAMEBUFFER, self.buffer)
+        glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0,
+                               GL_TEXTURE_2D, self.texture, 0)
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            raise FrameBufferError('Frame Buffer Object is incomplete: '
+                                   '0x%x' % status)
+
+    def __del__(self):
+        glDeleteFramebuffers(1, GLuint(self.buffer))
+        glDeleteTextures(1, GLuint(self.texture))
+
+# ------------------------------------------------------------------
+# BINDING MODULES
+# ------------------------------------------------------------------
+
+    def bind(self):
+        """
+        Draw into the texture, over the whole of it
+        """
+        glBindFramebuffer(GL_FRAMEBUFFER, self.buffer)
+        glViewport(0, 0, self.width, self.height)
+
+    def unbind(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+
+if __name__ == '__main__':
+    # Run the experiment even without running it directly from main.py
+    from main import run_experiment
+    run_experiment()
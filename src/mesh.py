@@ -0,0 +1,862 @@
+from numpy import (
+                   absolute, append, arange, array, asarray, column_stack,
+                   concatenate, cumsum, dot, dstack, empty, floor, full,
+                   hstack, identity, minimum, nonzero, ones, pad, repeat,
+                   rint, tile, unique, where, zeros,
+                   float16, float32, int16, int32, int64, uint16, uint32
+)
+
+from collections import deque
+
+from time import time
+
+from settings import WIDTH, HEIGHT, STEP_SIZE, VERTEX_CACHE_SIZE
+from tools import get_coords_array, get_time, shader_luminance
+
+
+# Index used to restart a triangle strip when primitive restart is enabled
+RESTART_INDEX = 0xFFFFFFFF
+# Normal shared by every vertex of the flat meshgrid
+NORMAL = (0.0, 0.0, 1.0)
+
+
+# ------------------------------------------------------------------
+# HANDLE GRID POINTS
+# ------------------------------------------------------------------
+
+def grid_origins(step=STEP_SIZE, width=WIDTH, height=HEIGHT):
+    """
+    Get the X and Y pixel positions of the bottom left corner of every
+    quadrilateral in the meshgrid
+
+    The positions are ordered column by column, X outer and Y inner,
+    as they were in the original nested loop of Render.__stimuli_VBO
+
+    >>> grid_origins(2, 4, 4)
+    (array([0, 0, 2, 2]), array([0, 2, 0, 2]))
+    """
+    X = arange(0, width - step + 1, step)
+    Y = arange(0, height - step + 1, step)
+    return repeat(X, len(Y)), tile(Y, len(X))
+
+
+def grid_cells(step=STEP_SIZE, width=WIDTH, height=HEIGHT):
+    """
+    Get the number of quadrilaterals along the X and Y axes of the
+    meshgrid
+
+    >>> grid_cells(2, 4, 6)
+    (2, 3)
+    """
+    return (len(xrange(0, width - step + 1, step)),
+            len(xrange(0, height - step + 1, step)))
+
+
+# ------------------------------------------------------------------
+# HANDLE MESH GENERATION
+# ------------------------------------------------------------------
+
+def build_quads(scaleX, scaleY, step=STEP_SIZE, width=WIDTH, height=HEIGHT):
+    """
+    Build the vertex, texcoord and normal arrays for the stimuli as
+    unindexed quadrilaterals, ready to be drawn with GL_QUADS
+
+    Every quadrilateral holds its corners in the order:
+        BOTTOM LEFT, BOTTOM RIGHT, TOP RIGHT, TOP LEFT
+    """
+    # Get the bottom left corner of every quadrilateral
+    X, Y = grid_origins(step, width, height)
+
+    # Offset of each corner from the bottom left corner
+    corner_x = array([0, step, step, 0])
+    corner_y = array([0, 0, step, step])
+
+    # Expand every quadrilateral into its 4 corners
+    X = (X[:, None] + corner_x[None, :]).ravel()
+    Y = (Y[:, None] + corner_y[None, :]).ravel()
+
+    # Calculate the texture coordinates and the vertices in one pass
+    x, y, vertX, vertY = get_coords_array(X, Y, scaleX, scaleY)
+
+    return {
+            'vertex': column_stack((vertX, vertY)).astype(float32),
+            'texcoord': column_stack((x, y)).astype(float32),
+            'normal': tile(array(NORMAL, dtype=float32), (len(X), 1))
+    }
+
+
+def build_grid(scaleX, scaleY, step=STEP_SIZE, width=WIDTH, height=HEIGHT):
+    """
+    Build the vertex, texcoord and normal arrays for the stimuli as a
+    shared vertex meshgrid, where every grid vertex is stored only once
+
+    The vertices are ordered column by column, so the vertex at grid
+    position (i, j) is found at index i * (rows + 1) + j
+    """
+    columns, rows = grid_cells(step, width, height)
+
+    # Get every vertex of the meshgrid, including the top and right edges
+    X = repeat(arange(columns + 1) * step, rows + 1)
+    Y = tile(arange(rows + 1) * step, columns + 1)
+
+    # Calculate the texture coordinates and the vertices in one pass
+    x, y, vertX, vertY = get_coords_array(X, Y, scaleX, scaleY)
+
+    return {
+            'vertex': column_stack((vertX, vertY)).astype(float32),
+            'texcoord': column_stack((x, y)).astype(float32),
+            'normal': tile(array(NORMAL, dtype=float32), (len(X), 1))
+    }
+
+
+def triangle_indices(step=STEP_SIZE, width=WIDTH, height=HEIGHT,
+                     window=None, order='column'):
+    """
+    Build the indices into build_grid for drawing the meshgrid with
+    GL_TRIANGLES
+
+    Every quadrilateral is split along its BOTTOM LEFT to TOP RIGHT
+    diagonal, in the same way that GL_QUADS is split by the driver
+
+    If window is set, as in tile_windows, only the quadrilaterals within
+    it are drawn. The triangles are drawn in the given order, as in
+    order_triangles
+
+    >>> triangle_indices(1, 1, 1)
+    array([0, 2, 3, 0, 3, 1], dtype=uint32)
+    """
+    columns, rows = grid_cells(step, width, height)
+    x0, y0, x1, y1 = window or (0, 0, columns, rows)
+
+    # Get the BOTTOM LEFT corner of every quadrilateral, column by column
+    bottom_left = (arange(x0, x1)[:, None] * (rows + 1) +
+                   arange(y0, y1)[None, :]).ravel()
+    bottom_right = bottom_left + rows + 1
+    top_right = bottom_right + 1
+    top_left = bottom_left + 1
+
+    indices = column_stack((bottom_left, bottom_right, top_right,
+                            bottom_left, top_right, top_left))\
+        .ravel().astype(uint32)
+    return order_triangles(indices, order, rows)
+
+
+def strip_indices(step=STEP_SIZE, width=WIDTH, height=HEIGHT, window=None):
+    """
+    Build the indices into build_grid for drawing the meshgrid with
+    GL_TRIANGLE_STRIP, one strip per row of quadrilaterals with the
+    strips separated by RESTART_INDEX
+
+    Each strip alternates between the top and the bottom vertex of the
+    row, so that every quadrilateral is split along the same diagonal
+    as with triangle_indices
+
+    If window is set, as in tile_windows, only the quadrilaterals within
+    it are drawn
+
+    >>> strip_indices(1, 2, 1)
+    array([1, 0, 3, 2, 5, 4], dtype=uint32)
+    """
+    columns, rows = grid_cells(step, width, height)
+    x0, y0, x1, y1 = window or (0, 0, columns, rows)
+
+    # The bottom vertices of every row, one row per line
+    bottom = arange(x0, x1 + 1)[None, :] * (rows + 1) + \
+        arange(y0, y1)[:, None]
+    # Interleave the top and bottom vertices of each row
+    strips = dstack((bottom + 1, bottom)).reshape(y1 - y0, -1)
+    # End every row with the restart index
+    strips = hstack((strips, full((y1 - y0, 1), RESTART_INDEX,
+                                  dtype=uint32)))
+
+    # The last restart index is not needed
+    return strips.ravel()[:-1].astype(uint32)
+
+
+# ------------------------------------------------------------------
+# HANDLE TILES
+# ------------------------------------------------------------------
+
+def tile_windows(tile_size, step=STEP_SIZE, width=WIDTH, height=HEIGHT):
+    """
+    Split the meshgrid into tiles of tile_size by tile_size
+    quadrilaterals, ordered column by column as the quadrilaterals are
+
+    Each tile is given as the window of quadrilaterals it covers:
+        FIRST COLUMN, FIRST ROW, LAST COLUMN + 1, LAST ROW + 1
+
+    >>> tile_windows(2, 1, 3, 2).tolist()
+    [[0, 0, 2, 2], [2, 0, 3, 2]]
+    """
+    columns, rows = grid_cells(step, width, height)
+    x0 = arange(0, columns, tile_size)
+    y0 = arange(0, rows, tile_size)
+    x0, y0 = repeat(x0, len(y0)), tile(y0, len(x0))
+    return column_stack((x0, y0, minimum(x0 + tile_size, columns),
+                         minimum(y0 + tile_size, rows)))
+
+
+def tile_indices(tile_size, strip=False, step=STEP_SIZE, width=WIDTH,
+                 height=HEIGHT, order='column'):
+    """
+    Build the indices into build_grid one tile after another, so that
+    every tile is drawn from a range of indices of its own
+
+    The indices are built with strip_indices if strip is set, otherwise
+    with triangle_indices in the given order. Every strip of a tile ends
+    with RESTART_INDEX, so that tiles drawn one after another are kept
+    apart
+
+    >>> indices = tile_indices(2, True, 1, 3, 2)
+    >>> len(indices) == tile_ranges(2, True, 1, 3, 2)[:, 1].sum()
+    True
+    """
+    indices = []
+    for window in tile_windows(tile_size, step, width, height).tolist():
+        if strip:
+            indices.append(append(strip_indices(step, width, height, window),
+                                  RESTART_INDEX))
+        else:
+            indices.append(triangle_indices(step, width, height, window,
+                                            order))
+    return concatenate(indices).astype(uint32)
+
+
+def tile_ranges(tile_size, strip=False, step=STEP_SIZE, width=WIDTH,
+                height=HEIGHT):
+    """
+    Get the first index and the number of indices of every tile built
+    by tile_indices
+
+    >>> tile_ranges(2, False, 1, 3, 2).tolist()
+    [[0, 24], [24, 12]]
+    """
+    windows = tile_windows(tile_size, step, width, height)
+    columns = windows[:, 2] - windows[:, 0]
+    rows = windows[:, 3] - windows[:, 1]
+
+    if strip:
+        # Every row is a strip of 2 vertices per column of vertices,
+        # followed by the restart index
+        counts = rows * (2 * (columns + 1) + 1)
+    else:
+        # Every quadrilateral is drawn as 2 triangles
+        counts = rows * columns * 6
+    return column_stack((cumsum(counts) - counts, counts))
+
+
+def tile_bounds(heights, scaleX, scaleY, tile_size, step=STEP_SIZE,
+                width=WIDTH, height=HEIGHT):
+    """
+    Get the bounding box of every tile of the meshgrid, once displaced
+    by heights, as the lowest and the highest X, Y and Z of the tile
+
+    heights holds the displacement of every texel of the height map,
+    the displacement is interpolated linearly between the vertices so
+    the mesh never leaves the box of the samples at its vertices
+    """
+    columns, rows = grid_cells(step, width, height)
+    # Sample the heights at every vertex of the uniform meshgrid
+    samples = corner_samples(heights)[:rows * step + 1:step,
+                                      :columns * step + 1:step]
+
+    windows = tile_windows(tile_size, step, width, height)
+    # Get the vertices at the BOTTOM LEFT and TOP RIGHT of every tile
+    x, y, lowX, lowY = get_coords_array(windows[:, 0] * step,
+                                        windows[:, 1] * step, scaleX, scaleY)
+    x, y, highX, highY = get_coords_array(windows[:, 2] * step,
+                                          windows[:, 3] * step, scaleX,
+                                          scaleY)
+
+    bounds = empty((len(windows), 2, 3), dtype=float32)
+    bounds[:, 0, 0], bounds[:, 0, 1] = lowX, lowY
+    bounds[:, 1, 0], bounds[:, 1, 1] = highX, highY
+    for i, (x0, y0, x1, y1) in enumerate(windows.tolist()):
+        block = samples[y0:y1 + 1, x0:x1 + 1]
+        bounds[i, 0, 2], bounds[i, 1, 2] = block.min(), block.max()
+    return bounds
+
+
+def visible_tiles(bounds, matrix):
+    """
+    Get which tiles have a bounding box that is at least partly within
+    the view, where matrix takes the row vectors of the model to clip
+    coordinates
+
+    A tile is culled when all 8 corners of its box lie beyond the same
+    plane of the view
+
+    >>> bounds = array([[[-1.0, -1.0, 0.0], [1.0, 1.0, 0.0]],
+    ...                 [[2.0, 2.0, 0.0], [3.0, 3.0, 0.0]]])
+    >>> visible_tiles(bounds, identity(4)).tolist()
+    [True, False]
+    """
+    # Pick the low or the high value of each axis for the 8 corners
+    pick = array([[i & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)])
+    corners = ones((len(bounds), 8, 4))
+    for axis in range(3):
+        corners[:, :, axis] = bounds[:, pick[:, axis], axis]
+
+    clip = dot(corners, matrix)
+    w = clip[:, :, 3:]
+    outside = (clip[:, :, :3] < -w).all(axis=1) | \
+        (clip[:, :, :3] > w).all(axis=1)
+    return ~outside.any(axis=1)
+
+
+def visible_runs(ranges, visible):
+    """
+    Merge the ranges of indices of the visible tiles, so that tiles
+    following on from one another are drawn by a single draw call
+
+    Returns the first index and the number of indices of every run
+
+    >>> visible_runs(array([[0, 6], [6, 6], [12, 6]]),
+    ...              array([True, True, False]))
+    [(0, 12)]
+    """
+    first = ranges[visible, 0]
+    end = first + ranges[visible, 1]
+    if not len(first):
+        return []
+
+    # A run starts wherever a tile does not follow on from the last one
+    starts = ones(len(first), dtype=bool)
+    starts[1:] = first[1:] != end[:-1]
+    ends = append(starts[1:], True)
+    return zip(first[starts].tolist(), (end[ends] - first[starts]).tolist())
+
+
+# ------------------------------------------------------------------
+# HANDLE VERTEX CACHE
+# ------------------------------------------------------------------
+
+def order_triangles(indices, order, rows, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Reorder the GL_TRIANGLES indices into the vertices numbered column
+    by column as in build_grid, so that the vertices shared by nearby
+    triangles are still in the vertex cache when they are reused:
+        'column'  - Column by column, as the meshgrid is numbered
+        'morton'  - Along the Z-order curve over the quadrilaterals
+        'forsyth' - Greedily by the vertex cache, see forsyth_order
+
+    >>> order_triangles(triangle_indices(1, 2, 2), 'morton', 2)[6:12]
+    array([3, 6, 7, 3, 7, 4], dtype=uint32)
+    """
+    if order == 'morton':
+        triangles = indices.reshape(-1, 3)
+        # Place each triangle at the lowest corner it touches
+        X = (triangles // (rows + 1)).min(axis=1)
+        Y = (triangles % (rows + 1)).min(axis=1)
+        keys = morton_codes(X, Y)
+        return triangles[keys.argsort(kind='mergesort')].ravel()
+    elif order == 'forsyth':
+        return forsyth_order(indices, cache_size)
+    return indices
+
+
+def morton_codes(X, Y):
+    """
+    Interleave the bits of X and Y into their position along the
+    Z-order curve
+
+    >>> morton_codes(array([0, 1, 0, 1, 2]), array([0, 0, 1, 1, 0])).tolist()
+    [0, 1, 2, 3, 4]
+    """
+    codes = zeros(len(X), dtype=int64)
+    for bit in range(32):
+        codes |= ((asarray(X, dtype=int64) >> bit) & 1) << (2 * bit)
+        codes |= ((asarray(Y, dtype=int64) >> bit) & 1) << (2 * bit + 1)
+    return codes
+
+
+def forsyth_order(indices, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Reorder the GL_TRIANGLES indices with Tom Forsyth's linear-speed
+    vertex cache optimisation
+
+    Every step draws the triangle with the best score among those using
+    a vertex in the cache. The score of a vertex favours vertices used
+    recently and vertices with few triangles left to draw
+
+    NOTE: This runs in Python one triangle at a time, so it is slow for
+          large meshes. The result is kept in the mesh cache
+    """
+    triangles = indices.reshape(-1, 3).tolist()
+    count = len(triangles)
+
+    # The triangles still to be drawn for every vertex
+    using = {}
+    for t, triangle in enumerate(triangles):
+        for v in triangle:
+            using.setdefault(v, []).append(t)
+
+    # Scores for the position of a vertex in the cache, where the last
+    # triangle drawn is given the same score regardless of its order
+    position_score = [0.75] * 3 + \
+        [(1.0 - (i - 3) / float(cache_size - 3)) ** 1.5
+         for i in range(3, cache_size)]
+    # Scores for the number of triangles left to draw for a vertex
+    most = max(len(t) for t in using.values())
+    valence_score = [0.0] + [2.0 * k ** -0.5 for k in range(1, most + 1)]
+
+    drawn = [False] * count
+    cache = []
+    order = []
+    # The next triangle to start from when no vertex in the cache has
+    # triangles left to draw
+    start = 0
+    while len(order) < count:
+        score = {}
+        for i, v in enumerate(cache):
+            score[v] = position_score[i] + valence_score[len(using[v])]
+
+        best, best_score = -1, -1.0
+        for v in cache:
+            for t in using[v]:
+                a, b, c = triangles[t]
+                total = score.get(a, 0.0) + score.get(b, 0.0) + \
+                    score.get(c, 0.0)
+                if total > best_score:
+                    best, best_score = t, total
+
+        if best < 0:
+            while drawn[start]:
+                start += 1
+            best = start
+
+        # Draw the triangle and move its vertices to the front of the
+        # cache
+        drawn[best] = True
+        order.append(best)
+        triangle = triangles[best]
+        for v in triangle:
+            using[v].remove(best)
+        cache = triangle + [v for v in cache if v not in triangle]
+        del cache[cache_size:]
+
+    return asarray(triangles, dtype=uint32)[order].ravel()
+
+
+def acmr(indices, cache_size=VERTEX_CACHE_SIZE, strip=False):
+    """
+    Get the average cache miss ratio of the indices, the number of
+    vertices processed per triangle drawn, for a FIFO vertex cache of
+    cache_size vertices
+
+    If strip is set, the indices are drawn as GL_TRIANGLE_STRIP with
+    the strips separated by RESTART_INDEX, otherwise as GL_TRIANGLES
+
+    >>> acmr(triangle_indices(1, 1, 1))
+    2.0
+    >>> acmr(strip_indices(1, 2, 1), strip=True)
+    1.5
+    """
+    cache = deque()
+    cached = set()
+    misses = 0
+    for v in indices.tolist():
+        if v == RESTART_INDEX or v in cached:
+            continue
+        misses += 1
+        cache.append(v)
+        cached.add(v)
+        if len(cache) > cache_size:
+            cached.discard(cache.popleft())
+
+    if strip:
+        # Every strip draws 2 triangles fewer than it has indices,
+        # leaving out the restart index between each of the strips
+        strips = (indices == RESTART_INDEX).sum() + 1
+        triangles = len(indices) - (strips - 1) - strips * 2
+    else:
+        triangles = len(indices) // 3
+    return round(misses / float(triangles), 4)
+
+
+def report_acmr(cache_size=VERTEX_CACHE_SIZE, step=STEP_SIZE, width=WIDTH,
+                height=HEIGHT):
+    """
+    Print the average cache miss ratio of every order of the meshgrid,
+    for choosing MESH_ORDER
+
+    The ratio is 0.5 at best for a large meshgrid, where every vertex
+    is processed once for its 2 triangles, and 3.0 at worst
+    """
+    print 'Average cache miss ratio for a cache of %d vertices:' % \
+        cache_size
+    print 'strip\t\t%s' % acmr(strip_indices(step, width, height),
+                               cache_size, True)
+    for order in ['column', 'morton', 'forsyth']:
+        t0 = time()
+        indices = triangle_indices(step, width, height, order=order)
+        print '%s\t\t%s\t(ordered in %s seconds)' % \
+            (order, acmr(indices, cache_size), get_time(t0, time()))
+
+
+# ------------------------------------------------------------------
+# HANDLE ADAPTIVE MESH
+# ------------------------------------------------------------------
+
+def build_adaptive(heights, max_error, scaleX, scaleY, step=STEP_SIZE,
+                   width=WIDTH, height=HEIGHT, order='column'):
+    """
+    Build the vertex, texcoord and normal arrays and the GL_TRIANGLES
+    indices for a mesh that is only dense where heights curves
+
+    heights holds the displacement of every texel of the height map.
+    The meshgrid is split as a quadtree, down to single quadrilaterals,
+    wherever a node differs from the uniformly dense meshgrid by more
+    than max_error. The triangles are drawn in the given order, as in
+    order_triangles
+    """
+    columns, rows = grid_cells(step, width, height)
+    # Sample the heights at every vertex of the uniform meshgrid
+    samples = corner_samples(heights)[:rows * step + 1:step,
+                                      :columns * step + 1:step]
+
+    # Get the size of the leaf of the quadtree covering each quadrilateral
+    sizes = leaf_sizes(samples, max_error)
+    # Triangulate the leaves, using the vertex numbering of build_grid
+    indices = order_triangles(leaf_indices(sizes), order, rows)
+
+    # Keep only the vertices that are used, numbering them anew
+    used, indices = unique(indices, return_inverse=True)
+    X = used // (rows + 1) * step
+    Y = used % (rows + 1) * step
+
+    # Calculate the texture coordinates and the vertices in one pass
+    x, y, vertX, vertY = get_coords_array(X, Y, scaleX, scaleY)
+
+    return {
+            'vertex': column_stack((vertX, vertY)).astype(float32),
+            'texcoord': column_stack((x, y)).astype(float32),
+            'normal': tile(array(NORMAL, dtype=float32), (len(X), 1)),
+            'index': indices.astype(uint32)
+    }
+
+
+def corner_samples(image):
+    """
+    Sample the image at every vertex of the full resolution meshgrid,
+    as the texture is sampled there with GL_LINEAR and GL_REPEAT
+
+    Every vertex lies on the corner of 4 texels, so its sample is their
+    average. The result has one more row and column than the image
+
+    >>> corner_samples(array([[0.0, 4.0], [8.0, 12.0]])).tolist()
+    [[6.0, 6.0, 6.0], [6.0, 6.0, 6.0], [6.0, 6.0, 6.0]]
+    """
+    padded = pad(image, [(1, 1), (1, 1)] + [(0, 0)] * (image.ndim - 2),
+                 mode='wrap')
+    return (padded[:-1, :-1] + padded[:-1, 1:] +
+            padded[1:, :-1] + padded[1:, 1:]) / 4.0
+
+
+def leaf_sizes(samples, max_error):
+    """
+    Get the size of the quadtree leaf covering each quadrilateral, for
+    the meshgrid with the heights given by samples
+
+    The quadtree is balanced, so that leaves sharing an edge differ in
+    size by a factor of 2 at most
+    """
+    rows, columns = samples.shape[0] - 1, samples.shape[1] - 1
+
+    # The root nodes are as large as the meshgrid allows
+    root = 1
+    while not columns % (root * 2) and not rows % (root * 2):
+        root *= 2
+    sizes = full((rows, columns), root, dtype=int32)
+
+    # Split every leaf that is further off than max_error
+    size = root
+    while size > 1:
+        split = (sizes[::size, ::size] == size) & \
+                (node_errors(samples, size) > max_error)
+        sizes[expand(split, size)] = size // 2
+        size //= 2
+
+    balance(sizes, root)
+    return sizes
+
+
+def node_errors(samples, size):
+    """
+    Get the largest difference between samples and the 4 triangles
+    fanned from the center of each node of the given size
+    """
+    rows = (samples.shape[0] - 1) // size
+    columns = (samples.shape[1] - 1) // size
+    errors = empty((rows, columns), dtype=float32)
+
+    # Offsets of the samples from the bottom left corner of the node
+    offsets = arange(size + 1)
+    ix = (arange(columns) * size)[:, None] + offsets[None, :]
+
+    # Work through a few rows of nodes at a time, to bound the memory
+    chunk = max(1, 2 ** 22 // (columns * (size + 1) ** 2))
+    for row in xrange(0, rows, chunk):
+        iy = (arange(row, min(row + chunk, rows)) * size)[:, None] + \
+            offsets[None, :]
+        # Gather the samples covered by each node, as [row, column]
+        blocks = samples[iy[:, None, :, None], ix[None, :, None, :]]
+        errors[row:row + chunk] = fan_error(blocks)
+    return errors
+
+
+def fan_error(blocks):
+    """
+    Get the largest difference between each block of samples and the
+    4 triangles fanned from its center to its corners
+
+    >>> fan_error(array([[[[0.0, 0.0, 0.0],
+    ...                    [0.0, 1.0, 0.0],
+    ...                    [0.0, 0.0, 4.0]]]])).tolist()
+    [[2.0]]
+    """
+    size = blocks.shape[-1] - 1
+    half = size // 2
+
+    # Position of each sample within the block on a 0.0 - 1.0 scale
+    u = arange(size + 1)[None, :] / float(size)
+    v = arange(size + 1)[:, None] / float(size)
+
+    bl = blocks[..., :1, :1]
+    br = blocks[..., :1, -1:]
+    tr = blocks[..., -1:, -1:]
+    tl = blocks[..., -1:, :1]
+    c = blocks[..., half:half + 1, half:half + 1]
+
+    # Interpolate within each of the triangles of the fan
+    bottom = (1 - u - v) * bl + (u - v) * br + 2 * v * c
+    top = (v - u) * tl + (u + v - 1) * tr + 2 * (1 - v) * c
+    left = (1 - u - v) * bl + (v - u) * tl + 2 * u * c
+    right = (u - v) * br + (u + v - 1) * tr + 2 * (1 - u) * c
+
+    fan = where((v <= u) & (v <= 1 - u), bottom,
+                where((v >= u) & (v >= 1 - u), top,
+                      where(u <= v, left, right)))
+    return absolute(blocks - fan).max(axis=-1).max(axis=-1)
+
+
+def balance(sizes, root):
+    """
+    Split the leaves of the quadtree until no leaf shares an edge with
+    a leaf less than half its size
+    """
+    changed = True
+    while changed:
+        changed = False
+
+        # Get the smallest leaf size among each quadrilateral and the
+        # quadrilaterals sharing an edge with it
+        smallest = sizes.copy()
+        smallest[1:] = minimum(smallest[1:], sizes[:-1])
+        smallest[:-1] = minimum(smallest[:-1], sizes[1:])
+        smallest[:, 1:] = minimum(smallest[:, 1:], sizes[:, :-1])
+        smallest[:, :-1] = minimum(smallest[:, :-1], sizes[:, 1:])
+
+        size = root
+        while size > 1:
+            rows, columns = sizes.shape[0] // size, sizes.shape[1] // size
+            neighbour = smallest.reshape(rows, size, columns, size)\
+                .min(axis=3).min(axis=1)
+            split = (sizes[::size, ::size] == size) & (neighbour < size // 2)
+            if split.any():
+                sizes[expand(split, size)] = size // 2
+                changed = True
+            size //= 2
+
+
+def leaf_indices(sizes):
+    """
+    Get the GL_TRIANGLES indices for the leaves of the quadtree, into
+    the vertices numbered column by column as in build_grid
+
+    Leaves of size 1 are split in the same way as triangle_indices, all
+    other leaves are fanned from their center, through the midpoint of
+    each edge shared with smaller leaves
+    """
+    rows, columns = sizes.shape
+
+    def vertex(X, Y):
+        return X * (rows + 1) + Y
+
+    def smaller(Y, X, size):
+        # Whether the quadrilateral at Y, X is covered by a smaller leaf
+        result = zeros(len(X), dtype=bool)
+        inside = (X >= 0) & (X < columns) & (Y >= 0) & (Y < rows)
+        result[inside] = sizes[Y[inside], X[inside]] < size
+        return result
+
+    triangles = []
+    size = sizes.max()
+    while size >= 1:
+        Y, X = nonzero(sizes[::size, ::size] == size)
+        X0, Y0 = X * size, Y * size
+        X1, Y1 = X0 + size, Y0 + size
+
+        # BOTTOM LEFT, BOTTOM RIGHT, TOP RIGHT and TOP LEFT corners
+        corners = [vertex(X0, Y0), vertex(X1, Y0),
+                   vertex(X1, Y1), vertex(X0, Y1)]
+
+        if size == 1:
+            triangles.append(column_stack((corners[0], corners[1],
+                                           corners[2])))
+            triangles.append(column_stack((corners[0], corners[2],
+                                           corners[3])))
+        else:
+            half = size // 2
+            center = vertex(X0 + half, Y0 + half)
+            # Midpoints of the BOTTOM, RIGHT, TOP and LEFT edges
+            middles = [vertex(X0 + half, Y0), vertex(X1, Y0 + half),
+                       vertex(X0 + half, Y1), vertex(X0, Y0 + half)]
+            # Whether the leaf across each of the edges is smaller
+            needed = [smaller(Y0 - 1, X0, size), smaller(Y0, X1, size),
+                      smaller(Y1, X0, size), smaller(Y0, X0 - 1, size)]
+
+            for k in range(4):
+                a, b = corners[k], corners[(k + 1) % 4]
+                m, n = middles[k], needed[k]
+                triangles.append(column_stack((center[~n], a[~n], b[~n])))
+                triangles.append(column_stack((center[n], a[n], m[n])))
+                triangles.append(column_stack((center[n], m[n], b[n])))
+        size //= 2
+
+    return concatenate(triangles).ravel()
+
+
+def expand(mask, size):
+    """
+    Expand a mask over the nodes of the given size into a mask over
+    the quadrilaterals covered by them
+    """
+    return mask.repeat(size, axis=0).repeat(size, axis=1)
+
+
+# ------------------------------------------------------------------
+# HANDLE BAKED GEOMETRY
+# ------------------------------------------------------------------
+
+def bake(arrays, heightmap, normalmap, scale_factor):
+    """
+    Displace the vertices in arrays by heightmap and read their normals
+    from normalmap, exactly as the vertex shader does, so that the baked
+    vertex shader only has to transform them
+
+    heightmap and normalmap hold RGB pixels on a 0.0 - 1.0 scale, with
+    the bottom row first as loaded by tools.load_array. HEIGHT_RATIO is
+    left to the ModelViewMatrix, as it is for the displacement mapping
+    """
+    result = dict(arrays)
+    texcoord = arrays['texcoord']
+
+    # Displace every vertex along its normal by the grey value
+    grey = shader_luminance(sample_texture(heightmap, texcoord))
+    vertex = column_stack((arrays['vertex'], zeros(len(texcoord))))
+    result['vertex'] = (vertex + arrays['normal'] *
+                        (grey * scale_factor)[:, None]).astype(float32)
+
+    result['normal'] = sample_texture(normalmap, texcoord).astype(float32)
+    return result
+
+
+def sample_texture(image, texcoord):
+    """
+    Sample the image at every texcoord, as the texture is sampled with
+    GL_LINEAR and GL_REPEAT
+
+    >>> image = array([[[0.0], [4.0]], [[8.0], [12.0]]])
+    >>> sample_texture(image, array([[0.25, 0.25], [0.5, 0.5]])).tolist()
+    [[0.0], [6.0]]
+    """
+    rows, columns = image.shape[:2]
+    # Texel centers lie half a texel in from the texel corners
+    x = texcoord[:, 0] * columns - 0.5
+    y = texcoord[:, 1] * rows - 0.5
+    x0, y0 = floor(x), floor(y)
+    fx, fy = (x - x0)[:, None], (y - y0)[:, None]
+
+    x0 = x0.astype(int64) % columns
+    y0 = y0.astype(int64) % rows
+    x1, y1 = (x0 + 1) % columns, (y0 + 1) % rows
+
+    return image[y0, x0] * (1 - fx) * (1 - fy) + \
+        image[y0, x1] * fx * (1 - fy) + \
+        image[y1, x0] * (1 - fx) * fy + \
+        image[y1, x1] * fx * fy
+
+
+# ------------------------------------------------------------------
+# HANDLE VERTEX LAYOUT
+# ------------------------------------------------------------------
+
+def compact(arrays, vertex_format, scaleX, scaleY):
+    """
+    Convert the vertex, texcoord and normal arrays into compact types,
+    read back by OpenGL as floats through VertexBuffer.format:
+        vertex   - Half floats if vertex_format is 'half', shorts
+                   normalized over scaleX and scaleY if it is 'short',
+                   otherwise left as it is
+        texcoord - Normalized unsigned shorts
+        normal   - Packed into a single value by pack_normals
+
+    >>> compact({'vertex': array([[-30.0, 15.0]]),
+    ...          'texcoord': array([[0.0, 1.0]])},
+    ...         'short', 30.0, 30.0)['vertex'].tolist()
+    [[-32767, 16384]]
+    """
+    result = dict(arrays)
+    if vertex_format == 'half':
+        result['vertex'] = arrays['vertex'].astype(float16)
+    elif vertex_format == 'short':
+        scale = array([scaleX, scaleY])
+        result['vertex'] = rint(arrays['vertex'] / scale * 32767)\
+            .astype(int16)
+
+    result['texcoord'] = rint(arrays['texcoord'] * 65535).astype(uint16)
+    if 'normal' in arrays:
+        result['normal'] = pack_normals(arrays['normal'])
+    return result
+
+
+def pack_normals(normals):
+    """
+    Pack every normal into a single 2_10_10_10 value, as read by
+    OpenGL with GL_INT_2_10_10_10_REV, with the X, Y and Z components
+    as signed 10 bit values from the lowest bits up
+
+    >>> pack_normals(array([[0.0, 0.0, 1.0], [-1.0, 0.0, 0.0]])).tolist()
+    [535822336, 513]
+    """
+    packed = rint(asarray(normals) * 511).astype(int64) & 0x3FF
+    return (packed[:, 0] | (packed[:, 1] << 10) | (packed[:, 2] << 20))\
+        .astype(int32)
+
+
+def interleave(arrays, names):
+    """
+    Interleave the arrays named in names into a single structured array,
+    with one record per vertex holding a field for each of the arrays
+
+    >>> a = interleave({'vertex': array([[1.0, 2.0]], dtype=float32),
+    ...                 'texcoord': array([[0.5, 0.5]], dtype=float32)},
+    ...                ['vertex', 'texcoord'])
+    >>> a.dtype.itemsize, a.dtype.fields['texcoord'][1]
+    (16, 8)
+    """
+    # Describe each field by its type and number of components
+    dtype = [(name, arrays[name].dtype, arrays[name].shape[1:])
+             for name in names]
+
+    data = empty(len(arrays[names[0]]), dtype=dtype)
+    for name in names:
+        data[name] = arrays[name]
+    return data
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
+    report_acmr()
@@ -0,0 +1,199 @@
+from numpy import (
+                   asarray, dot, dstack, float32, pad, rint, stack, uint8,
+                   uint16, uint32, zeros
+)
+
+from cache import AssetCache, content_hash
+from settings import TEXTURE_COMPRESSION
+from tools import load_pixels
+
+
+class MipChain(object):
+    """
+    Hold the levels of the mip chain of an image, from the image itself
+    down to a single pixel, as arrays of pixels or as blocks compressed
+    by compress_bc1, ready to be uploaded as a texture
+
+    The shape and type are those of the image itself, so the chain can be
+    used in place of the array of pixels of the image
+    """
+
+    def __init__(self, levels, shape, dtype, compressed=False, *args,
+                 **kwargs):
+        """
+        Set the levels of the chain, along with the shape and type of
+        the pixels of the image
+        """
+        self.levels = levels
+        self.shape = shape
+        self.dtype = dtype
+        self.itemsize = dtype.itemsize
+        self.compressed = compressed
+        self.nbytes = sum(level.nbytes for level in levels)
+
+
+# ------------------------------------------------------------------
+# HANDLE MIP CHAINS
+# ------------------------------------------------------------------
+
+def build_levels(pixels):
+    """
+    Build the levels of the mip chain of the pixels, each half the width
+    and height of the one before down to a single pixel, by averaging
+    each 2 x 2 box of pixels
+
+    >>> levels = build_levels(asarray([[0, 4], [8, 12]], dtype=uint8))
+    >>> [level.tolist() for level in levels]
+    [[[0, 4], [8, 12]], [[6]]]
+    >>> [level.shape for level in build_levels(zeros((4, 2, 3), uint8))]
+    [(4, 2, 3), (2, 1, 3), (1, 1, 3)]
+    """
+    pixels = asarray(pixels)
+    levels = [pixels]
+    level = pixels.astype(float32)
+    while level.shape[0] > 1 or level.shape[1] > 1:
+        height, width = level.shape[:2]
+        # An axis of a single pixel is no longer halved, and the last
+        # pixel of an odd axis is dropped as OpenGL does
+        fy, fx = min(height, 2), min(width, 2)
+        height, width = height // fy, width // fx
+        boxes = level[:height * fy, :width * fx]
+        boxes = boxes.reshape((height, fy, width, fx) + level.shape[2:])
+        level = boxes.mean(axis=3).mean(axis=1)
+        levels.append(rint(level).astype(pixels.dtype))
+    return levels
+
+
+def load_mipmapped(filename, compression=TEXTURE_COMPRESSION):
+    """
+    Load the image along with its mip chain, loading the chain from the
+    asset cache or otherwise building it and storing it into the cache
+
+    If compression is set, the levels are compressed by compress_bc1
+
+    The shape and type of the image are cached along with the levels, so
+    the image is only decoded when its chain is built
+    """
+    return cache_mipmapped(content_hash(filename), load_pixels, filename,
+                           compression)
+
+
+def cache_mipmapped(image_key, load, source,
+                    compression=TEXTURE_COMPRESSION):
+    """
+    Load the mip chain of the image identified by image_key from the
+    asset cache, or otherwise build it from the pixels of the image
+    load(source) and store it into the cache
+    """
+    cache = AssetCache('mipmap')
+    key = cache.key(image_key, 'box', compression)
+
+    arrays = cache.load(key)
+    if arrays is None:
+        pixels = load(source)
+        levels = build_levels(pixels)
+        if compression:
+            levels = [compress_bc1(level) for level in levels]
+        arrays = dict(('level%d' % i, level) for i, level in
+                      enumerate(levels))
+        # The compressed levels have neither the shape nor the type of
+        # the image, so they are stored on their own
+        arrays['shape'] = asarray(pixels.shape)
+        arrays['dtype'] = zeros(0, pixels.dtype)
+        cache.save(key, arrays)
+
+    levels = [arrays['level%d' % i] for i in xrange(len(arrays) - 2)]
+    return MipChain(levels, tuple(int(size) for size in arrays['shape']),
+                    arrays['dtype'].dtype, compression)
+
+
+# ------------------------------------------------------------------
+# HANDLE BLOCK COMPRESSION
+# ------------------------------------------------------------------
+
+def compress_bc1(pixels):
+    """
+    Compress the pixels into BC1 (DXT1) blocks, 8 bytes for each block of
+    4 x 4 pixels, returned as an array of bytes in the order expected by
+    glCompressedTexImage2D
+
+    The two colors of each block are the corners of the box bounding
+    its pixels, and each pixel takes the closest of the four colors
+    along the line between them
+
+    >>> compress_bc1(zeros((4, 4), uint8) + 255).tolist()
+    [255, 255, 255, 255, 0, 0, 0, 0]
+    >>> compress_bc1(zeros((2, 6, 3), uint8)).shape
+    (16,)
+    """
+    pixels = asarray(pixels, dtype=float32)
+    # Greyscale images take the same value in each of r, g and b
+    if pixels.ndim < 3:
+        pixels = dstack([pixels] * 3)
+    pixels = pixels[..., :3]
+
+    # Repeat the last row and column to fill the blocks at the edges
+    height, width = pixels.shape[:2]
+    rows, columns = -(-height // 4), -(-width // 4)
+    pixels = pad(pixels, ((0, rows * 4 - height), (0, columns * 4 - width),
+                          (0, 0)), 'edge')
+    # Gather the 16 pixels of each block, row by row within the block
+    blocks = pixels.reshape(rows, 4, columns, 4, 3).transpose(0, 2, 1, 3, 4)
+    blocks = blocks.reshape(rows, columns, 16, 3)
+
+    # The brighter corner of the box is color0, so that color0 > color1
+    # and the block uses four colors, unless the block is a single color
+    color0 = to_565(blocks.max(axis=2))
+    color1 = to_565(blocks.min(axis=2))
+    end0, end1 = from_565(color0), from_565(color1)
+
+    # Project each pixel onto the line from color1 to color0
+    line = end0 - end1
+    length = (line * line).sum(axis=-1)
+    length[length == 0] = 1.0
+    t = ((blocks - end1[:, :, None]) * line[:, :, None]).sum(axis=-1)
+    t = rint(t.clip(0.0, length[..., None]) / length[..., None] * 3)
+    # Index of the color at each third of the way from color1 to color0
+    indices = asarray([1, 3, 2, 0], dtype=uint32)[t.astype(int)]
+    indices[color0 == color1] = 0
+
+    bits = dot(indices, (1 << (2 * asarray(range(16), dtype=uint32))))
+    packed = zeros((rows, columns, 4), dtype=uint16)
+    packed[..., 0] = color0
+    packed[..., 1] = color1
+    packed[..., 2] = bits & 0xFFFF
+    packed[..., 3] = bits >> 16
+    # Stored little endian, as read by OpenGL
+    return packed.astype('<u2').view(uint8).reshape(-1)
+
+
+def to_565(colors):
+    """
+    Quantize colors on a 0 - 255 scale into 16-bit 5:6:5 colors
+
+    >>> colors = asarray([[255.0, 255.0, 255.0], [255.0, 0.0, 0.0]])
+    >>> [int(color) for color in to_565(colors)]
+    [65535, 63488]
+    """
+    r = rint(colors[..., 0] * 31 / 255.0).astype(uint32)
+    g = rint(colors[..., 1] * 63 / 255.0).astype(uint32)
+    b = rint(colors[..., 2] * 31 / 255.0).astype(uint32)
+    return (r << 11) | (g << 5) | b
+
+
+def from_565(colors):
+    """
+    Expand 16-bit 5:6:5 colors back onto a 0 - 255 scale
+
+    >>> from_565(asarray([65535, 63488])).tolist()
+    [[255.0, 255.0, 255.0], [255.0, 0.0, 0.0]]
+    """
+    r = (colors >> 11) & 31
+    g = (colors >> 5) & 63
+    b = colors & 31
+    return stack([r * 255 / 31.0, g * 255 / 63.0, b * 255 / 31.0], axis=-1)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
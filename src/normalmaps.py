@@ -0,0 +1,83 @@
+from numpy import clip, dstack, ones, rint, roll, sqrt, uint8
+
+from cache import AssetCache, content_hash
+from settings import NORMALMAP_RATIO, SCALE_FACTOR, SCALE_X, SCALE_Y
+from tools import load_pixels, shader_luminance, unit_scale
+
+
+# ------------------------------------------------------------------
+# HANDLE NORMALMAPS
+# ------------------------------------------------------------------
+
+def build_normalmap(heightmap, ratio=NORMALMAP_RATIO):
+    """
+    Build the normalmap of the heightmap, an array as loaded by
+    tools.load_pixels, from the slopes of the surface the vertex shader
+    displaces it into at the height ratio
+
+    The slopes are found by central differences, wrapping around the
+    edges as the textures repeat. The normals are stored as the shipped
+    normalmaps store them, the X, Y and Z of the unit normal on a 0 - 255
+    scale, with negative values clipped to 0
+
+    >>> from numpy import arange, zeros
+    >>> build_normalmap(zeros((4, 4), uint8))[0, 0].tolist()
+    [0, 0, 255]
+    >>> slope = (255 - arange(4) * 64).astype(uint8)[None, :].repeat(4, 0)
+    >>> build_normalmap(slope)[2, 2].tolist()
+    [7, 0, 255]
+    """
+    pixels = unit_scale(heightmap)
+    if pixels.ndim < 3:
+        pixels = dstack([pixels] * 3)
+    heights = shader_luminance(pixels) * SCALE_FACTOR * ratio
+
+    # Distance between neighbouring pixels along X and Y on the mesh
+    dx = 2.0 * SCALE_X / heights.shape[1]
+    dy = 2.0 * SCALE_Y / heights.shape[0]
+    slope_x = (roll(heights, -1, axis=1) - roll(heights, 1, axis=1)) / (2 * dx)
+    slope_y = (roll(heights, -1, axis=0) - roll(heights, 1, axis=0)) / (2 * dy)
+
+    normal = dstack([-slope_x, -slope_y, ones(heights.shape)])
+    normal /= sqrt((normal * normal).sum(axis=-1))[..., None]
+    return rint(clip(normal, 0.0, 1.0) * 255).astype(uint8)
+
+
+def load_normalmap(sources, ratio=NORMALMAP_RATIO):
+    """
+    Load the normalmap for sources, the filenames of a heightmap and of
+    its normalmap, loading the normalmap if there is one or otherwise
+    the normalmap built from the heightmap
+
+    The normalmaps built are stored in the asset cache, so that they are
+    only built once for each heightmap
+    """
+    heightmap, normalmap = sources
+    if normalmap is not None:
+        return load_pixels(normalmap)
+
+    cache = AssetCache('normalmap')
+    key = normalmap_key(sources, ratio)
+    arrays = cache.load(key)
+    if arrays is None:
+        arrays = {'normalmap': build_normalmap(load_pixels(heightmap), ratio)}
+        cache.save(key, arrays)
+    return arrays['normalmap']
+
+
+def normalmap_key(sources, ratio=NORMALMAP_RATIO):
+    """
+    Get the key identifying the content of the normalmap for sources,
+    the hash of the normalmap if there is one, otherwise the key of the
+    normalmap built from the heightmap
+    """
+    heightmap, normalmap = sources
+    if normalmap is not None:
+        return content_hash(normalmap)
+    return AssetCache('normalmap').key(content_hash(heightmap), ratio,
+                                       SCALE_FACTOR, SCALE_X, SCALE_Y)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,36 @@
+from os.path import getsize
+
+from bundle import latest_bundle, write_bundle
+from cache import content_hash
+from settings import (
+                      COLORMAPS, HEIGHTMAPS, NORMALMAPS, IMG_MSG, IMG_FIX,
+                      STIMULI_BUNDLE
+)
+from tools import decode_pixels
+
+
+def pack(path=STIMULI_BUNDLE):
+    """
+    Decode all the images used by the experiment and pack them into the
+    bundle at path, to be memory-mapped by tools.load_pixels
+
+    Run this again whenever the images change, the images that have
+    changed since they were packed are decoded until then
+    """
+    # The normalmaps built from the heightmaps are kept in the asset
+    # cache instead
+    normalmaps = [filename for filename in NORMALMAPS if filename]
+    filenames = COLORMAPS + HEIGHTMAPS + normalmaps + IMG_MSG + [IMG_FIX]
+    maps = []
+    for filename in filenames:
+        maps.append((filename, content_hash(filename),
+                     decode_pixels(filename)))
+    write_bundle(path, maps)
+
+    print 'Packed %d images into %s, %.1f MB' % \
+        (len(maps), latest_bundle(path),
+         getsize(latest_bundle(path)) / (1024.0 * 1024.0))
+
+
+if __name__ == '__main__':
+    pack()
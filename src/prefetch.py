@@ -0,0 +1,105 @@
+from collections import OrderedDict
+
+from Queue import Empty, Queue
+
+from threading import Thread
+
+from settings import PREFETCH_WORKERS
+from tools import load_pixels
+
+
+class Prefetcher(object):
+    """
+    Decode the images of the upcoming stimuli into the arrays of pixels
+    used for their textures, with a small pool of worker threads, while the
+    fixation point and the messages are displayed
+
+    The decoded pixel data is handed back to the render thread through a
+    bounded queue, so the workers never get too far ahead of the stimuli
+    being displayed, and only as much of it is kept as the queue holds
+
+    NOTE: An image that fails to decode is handed back as None, so that
+          it is loaded again when it is used
+    """
+
+    def __init__(self, workers=PREFETCH_WORKERS, *args, **kwargs):
+        """
+        Start the worker threads, which wait for filenames to decode
+        """
+        self.requests = Queue()
+        # Bounded, so that the workers wait for the render thread to
+        # collect the pixel data before decoding any more
+        self.size = workers * 3
+        self.results = Queue(maxsize=self.size)
+        # Filenames requested and not collected yet
+        self.pending = set()
+        # Pixel data collected and not taken yet, keyed by the filename,
+        # from the least to the most recently collected
+        self.pixels = OrderedDict()
+
+        for i in xrange(workers):
+            worker = Thread(target=self.__work)
+            # Do not keep the experiment from exiting
+            worker.daemon = True
+            worker.start()
+
+    def request(self, filenames, load=load_pixels):
+        """
+        Decode the images in filenames in the background with load,
+        unless they are already being decoded
+        """
+        for filename in filenames:
+            if filename in self.pending or filename in self.pixels:
+                continue
+            self.pending.add(filename)
+            self.requests.put((filename, load))
+
+    def take(self, filename):
+        """
+        Take the pixel data decoded from filename, or None if it is not
+        ready yet
+        """
+        self.__collect()
+        return self.pixels.pop(filename, None)
+
+    def __collect(self):
+        """
+        Collect the pixel data decoded by the workers, without waiting
+        """
+        while True:
+            try:
+                filename, data = self.results.get_nowait()
+            except Empty:
+                return
+            self.pending.discard(filename)
+            if data is None:
+                continue
+            self.pixels[filename] = data
+            # Drop the pixel data collected the longest ago beyond the
+            # size of the queue, it is loaded again if it is used
+            while len(self.pixels) > self.size:
+                self.pixels.popitem(last=False)
+
+    def __work(self):
+        """
+        Decode the images requested, one at a time, for as long as the
+        experiment runs
+        """
+        while True:
+            filename, load = self.requests.get()
+            try:
+                data = load(filename)
+            except Exception as error:
+                # Keep the worker running, the image is loaded again on
+                # the render thread, where the error is raised if it
+                # fails again
+                print 'Decoding %s in the background failed: %s' % \
+                    (filename, error)
+                data = None
+            self.results.put((filename, data))
+
+
+if __name__ == '__main__':
+    # Run the experiment even without running it directly from main.py
+    from main import run_experiment
+    run_experiment()
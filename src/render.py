@@ -1,8 +1,7 @@
 from math import cos, sin
 
-from numpy import array, float32
-
-from pyglet.image import load
+from numpy import array, dot, float32, maximum, minimum, rint, uint8, zeros
+from numpy.linalg import inv
 
 from OpenGL.GL import *
 
@@ -12,20 +11,50 @@ from re import findall
 
 from time import time
 
-from buffers import VertexBuffer
+from blur import blur
+from buffers import (
+                     ElementBuffer, VertexBuffer,
+                     pointer, set_constant_attribute, set_constant_normal
+)
+from cache import AssetCache, content_hash
+from framebuffers import FrameBuffer
+from mesh import (
+                  build_adaptive, build_grid, build_quads, grid_cells,
+                  interleave, strip_indices, triangle_indices,
+                  tile_bounds, tile_indices, tile_ranges, visible_runs,
+                  visible_tiles, bake, compact,
+                  NORMAL, RESTART_INDEX
+)
 from modelview import ModelView
+from normalmaps import load_normalmap, normalmap_key
 from projection import Projection
 from settings import (
                       ENABLE_SHADER, GLSL_VERSION, VERTEX_SHADER_FILE, FRAGMENT_SHADER_FILE,
+                      BAKED_GEOMETRY, BAKED_VERTEX_SHADER_FILE,
+                      BLUR_VERTEX_SHADER_FILE, BLUR_FRAGMENT_SHADER_FILE,
+                      GPU_BLUR, TRIAL_BLURS,
+                      CONSTANT_NORMAL, INTERLEAVED_VBO,
+                      COMPACT_VBO, VERTEX_FORMAT,
+                      ADAPTIVE_MESH, ADAPTIVE_MAX_ERROR,
+                      FRUSTUM_CULLING, TILE_SIZE,
+                      HEIGHTMAPS, HEIGHT_RATIO, NORMALMAPS, SCALE_FACTOR,
                       IMG_FIX, IMG_MSG,
                       LIGHT_COLOR, LIGHT_POSITION, LIGHT_DIRECTION, NUM_LIGHTS,
-                      RENDER_SOLID,
+                      MESH_MODE, MESH_ORDER, PROCEDURAL_GRID, RENDER_SOLID,
+                      VERTEX_CACHE_SIZE,
                       SCALE_X, SCALE_Y, STIMULI_DEPTH,
+                      INSTANCED_DRAWING, MULTI_STIMULI, TEXTURE_ARRAYS,
+                      ASYNC_UPLOAD, PACKED_MAPS,
                       STEP_SIZE, WIDTH, HEIGHT,
                       STIMULI_ONLY, PER_PIXEL
 )
 from shaders import FragmentShader, VertexShader, ShaderProgram
-from tools import get_coords, get_time, opengl_info, pixel_access, deg_to_rad
+from textures import TextureCache, upload_array
+from tools import (
+                   get_time, opengl_info, deg_to_rad,
+                   load_all_pixels, load_array, set_source, shader_luminance,
+                   unit_scale
+)
 # from vbo import VBO
 
 
@@ -37,6 +66,18 @@ class Render(object):
     directly
     """
 
+    # Name, location in the vertex shader and number of components of
+    # each of the vertex attributes
+    attributes = [('vertex', 0, 2), ('texcoord', 1, 2), ('normal', 2, 3),
+                  ('offset', 3, 3)]
+    # Texture unit each of the texture arrays of the maps is bound to,
+    # apart from the units of the 2D maps
+    array_units = [('colormap_array', 3), ('heightmap_array', 4),
+                   ('normalmap_array', 5)]
+    # Texture unit the maps are bound to while they are blurred, apart
+    # from those of the maps and texture arrays used for drawing
+    blur_unit = 6
+
 # ------------------------------------------------------------------
 # HANDLE INITIALIZATION
 # ------------------------------------------------------------------
@@ -50,16 +91,38 @@ class Render(object):
         # Initialize the OpenGL parameters
         self.__init_GL()
         opengl_info()
+        # Keep the images uploaded as textures, so that each image is
+        # only uploaded once
+        self.texture_cache = TextureCache()
+        # Read the maps of the stimuli from texture arrays, by layer
+        self.texture_arrays = TEXTURE_ARRAYS and ENABLE_SHADER and \
+            GLSL_VERSION == 330
+        self.layer = 0
+        # Upload the textures of the next stimulus ahead of its display
+        # The texture arrays already hold the maps of all the stimuli
+        self.async_upload = ASYNC_UPLOAD and GLSL_VERSION == 330 and \
+            not self.texture_arrays
+        # Radius by which the maps of the next stimulus are blurred, and
+        # the pair of Frame Buffer Objects each map is blurred through
+        self.blur_radius = 0
+        self.blur_buffers = {}
+        # The maps are otherwise blurred on the CPU, see Stimuli
+        self.gpu_blur = GPU_BLUR and ENABLE_SHADER and GLSL_VERSION == 330
         stereo = False
 
         if not STIMULI_ONLY:
-            # Initiate the message textures we will use in the experiment
+            # Initiate the message and fixation point textures we will
+            # use in the experiment
             self.__init_messages()
-            # Initiate the fixation point texture we will use
-            self.__init_fix()
 
         # Initialize the geometry
         self.__init_geometry()
+        # Initialize the way the stimuli mesh is stored and drawn
+        self.__init_mesh_mode()
+        # Read the heightmap and normalmap from a single texture, unless
+        # they are already baked into the mesh
+        self.packed_maps = PACKED_MAPS and ENABLE_SHADER and \
+            GLSL_VERSION == 330 and not self.baked
         # Initialize the lighting
         self.__init_lighting()
 
@@ -93,24 +156,28 @@ class Render(object):
 
     def __init_messages(self):
         """
-        Prepare all the message images for rendering as textures
+        Prepare all the message images and the fixation point image for
+        rendering as textures, decoding them in parallel
         """
+        images = load_all_pixels(IMG_MSG + [IMG_FIX])
+        # Their textures are cached under their filenames
+        for filename, image in zip(IMG_MSG + [IMG_FIX], images):
+            set_source(image, filename)
+        # Load the fixation point image from directory
+        self.fix_image = images.pop()
+
         # Store all the message images here
         self.messages = {}
         # Iterating through all the message images
-        for filename in IMG_MSG:
+        for filename, image in zip(IMG_MSG, images):
             # Get the name of the message state
             state = findall(r'\\(\w+)\.jpg', filename)
             # If the regex finds something, use the first element
             # of the resultant list
             if state:
                 state = state[0]
-            # Load the image
-            self.messages[state] = load(filename)
-
-    def __init_fix(self):
-        # Load the fixation point image from directory
-        self.fix_image = load(IMG_FIX)
+            # Keep the image
+            self.messages[state] = image
 
     def __init_stereo(self, stereo):
         if stereo:
@@ -125,9 +192,22 @@ class Render(object):
                                   (-2.0, 0.0), (0.0, 0.0), (2.0, 0.0),
                                   (-2.0, -2.0), (0.0, -2.0), (2.0, -2.0)
         ]
-        self.translate_stimuli = [(0.0, 0.0)]
+        if not MULTI_STIMULI:
+            self.translate_stimuli = [(0.0, 0.0)]
         self.translate_message = [(0.0, 0.0)]
 
+        # Draw all the positions of the stimuli in a single draw call,
+        # each offset from the center by an instanced vertex attribute
+        self.instanced = INSTANCED_DRAWING and ENABLE_SHADER and \
+            GLSL_VERSION == 330
+        self.instances = 1
+        if self.instanced:
+            self.instances = len(self.translate_stimuli)
+        # The offsets of each position drawn, from the translation passed
+        # in the ModelViewMatrix
+        self.instance_offsets = zeros((self.instances, 3), dtype=float32)
+        self.instance_rot = None
+
     # def __init_VBO(self, args):
         # Calculate the width displacement from the midpoint of the screen
         # wd = round(self.fix_image.width / float(args[0]), 2)
@@ -177,6 +257,56 @@ class Render(object):
         glScalef(self.scale['X'], self.scale['Y'],
                  self.scale['Z'])
 
+    def __init_mesh_mode(self):
+        """
+        Set the way in which the meshgrid for the stimuli is stored and
+        drawn, as chosen by MESH_MODE
+        """
+        self.mesh_mode = MESH_MODE
+        # The procedural meshgrid is derived in the vertex shader, which
+        # is only available with GLSL_VERSION 330
+        if PROCEDURAL_GRID and ENABLE_SHADER and GLSL_VERSION == 330:
+            self.mesh_mode = 'procedural'
+        # The adaptive mesh is built to match the displacement mapping of
+        # the vertex shader with GLSL_VERSION 330
+        elif ADAPTIVE_MESH and ENABLE_SHADER and GLSL_VERSION == 330:
+            self.mesh_mode = 'adaptive'
+        # Primitive restart is not available before OpenGL 3.1, so we
+        # fall back onto indexed triangles
+        if self.mesh_mode == 'strip' and \
+           not (ENABLE_SHADER and GLSL_VERSION == 330):
+            self.mesh_mode = 'triangles'
+
+        # Set the primitive to be drawn for the chosen mode
+        if self.mesh_mode == 'strip':
+            self.stimuli_primitive = GL_TRIANGLE_STRIP
+        elif self.mesh_mode in ['triangles', 'procedural', 'adaptive']:
+            self.stimuli_primitive = GL_TRIANGLES
+        else:
+            self.stimuli_primitive = GL_QUADS
+
+        # The tiles are culled using the matrices passed to the shaders
+        self.tiled = FRUSTUM_CULLING and \
+            self.mesh_mode in ['triangles', 'strip'] and \
+            ENABLE_SHADER and GLSL_VERSION == 330
+        # The compact attributes are read back as floats by the vertex
+        # shader, while the procedural meshgrid has no attributes
+        self.compact = COMPACT_VBO and self.mesh_mode != 'procedural' and \
+            ENABLE_SHADER and GLSL_VERSION == 330
+        # The displacement mapping is baked into the attributes, which
+        # the procedural meshgrid does not have
+        self.baked = BAKED_GEOMETRY and self.mesh_mode != 'procedural' and \
+            ENABLE_SHADER and GLSL_VERSION == 330
+        # Each of the height maps has a mesh of its own if the mesh is
+        # built from the height map
+        self.mesh_per_map = self.mesh_mode == 'adaptive' or self.baked
+
+        # The baked vertices are displaced in Z, so they are not on the
+        # -1.0 - 1.0 scale of SCALE_X and SCALE_Y needed by shorts
+        self.vertex_format = VERTEX_FORMAT
+        if self.baked and VERTEX_FORMAT == 'short':
+            self.vertex_format = 'float'
+
 # ------------------------------------------------------------------
 # HANDLE MATRICES
 # ------------------------------------------------------------------
@@ -242,6 +372,12 @@ class Render(object):
             glEnableClientState(GL_VERTEX_ARRAY)
             glEnableClientState(GL_NORMAL_ARRAY)
 
+        if self.mesh_mode == 'strip':
+            # Allow each row of the meshgrid to be drawn as a separate
+            # triangle strip from within the same draw call
+            glEnable(GL_PRIMITIVE_RESTART)
+            glPrimitiveRestartIndex(RESTART_INDEX)
+
     def disable_GL_STATE(self):
         """
         Disables all enabled OpenGL states
@@ -260,6 +396,9 @@ class Render(object):
             glDisableClientState(GL_TEXTURE_COORD_ARRAY)
             glDisableClientState(GL_NORMAL_ARRAY)
 
+        if self.mesh_mode == 'strip':
+            glDisable(GL_PRIMITIVE_RESTART)
+
 # ------------------------------------------------------------------
 # HANDLE VERTEX BUFFER OBJECTS
 #
@@ -286,6 +425,17 @@ class Render(object):
             self.__message_VBO(window_width, window_height, scaleX, scaleY)
 
         self.stimuli_VBO = {}
+        self.mesh_cache = AssetCache('mesh')
+        if self.instanced:
+            # Create the Vertex Buffer Object to house the offset of each
+            # position of the stimuli, updated as the slant changes
+            self.instance_VBO = VertexBuffer(self.instance_offsets,
+                                             GL_DYNAMIC_DRAW, divisor=1)
+        # Size by which the vertex shader scales the vertices of the
+        # stimuli, which are stored on a -1.0 - 1.0 scale as shorts
+        self.vertex_scale = (1.0, 1.0)
+        if self.compact and self.vertex_format == 'short':
+            self.vertex_scale = (scaleX, scaleY)
         # Create the Vertex Buffer Object to house the texture
         # coordinates, vertices and normals for the stimuli
         self.__stimuli_VBO(scaleX, scaleY)
@@ -295,10 +445,11 @@ class Render(object):
         Create the Vertex Buffer Objects for message display
         """
         # Calculate the width displacement from the midpoint of the screen
-        wd = round(self.fix_image.width / float(width), 2)
+        wd = round(self.fix_image.shape[1] / float(width), 2)
         # Calculate the height displacement from the midpoint of the screen
-        hd = round(self.fix_image.height / float(height), 2)
+        hd = round(self.fix_image.shape[0] / float(height), 2)
 
+        message = {}
         # Create the buffer array for Vertex
         l = [
              [(0.0 - wd) * scaleX, (0.0 - hd) * scaleY],
@@ -306,128 +457,315 @@ class Render(object):
              [(0.0 + wd) * scaleX, (0.0 + hd) * scaleY],
              [(0.0 - wd) * scaleX, (0.0 + hd) * scaleY]
         ]
-        self.message_VBO['vertex'] = VertexBuffer(array(l, dtype=float32))
+        message['vertex'] = array(l, dtype=float32)
 
         # Create the buffer array for TexCoord
         l = [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0]]
-        self.message_VBO['texcoord'] = VertexBuffer(array(l, dtype=float32))
+        message['texcoord'] = array(l, dtype=float32)
 
         # Create the buffer array for Normal
-        l = [[0.0, 0.0, 1.0], [0.0, 0.0, 1.0],
-             [0.0, 0.0, 1.0], [0.0, 0.0, 1.0]]
-        self.message_VBO['normal'] = VertexBuffer(array(l, dtype=float32))
-
-#     def __message_VBO2(self, width, height):
-#         """
-#         Create the Vertex Buffer Objects for message display
-#         """
-#         # Calculate the width displacement from the midpoint of the screen
-#         wd = round(self.fix_image.width / float(width), 2)
-#         # Calculate the height displacement from the midpoint of the screen
-#         hd = round(self.fix_image.height / float(height), 2)
-#
-#         vertices = [
-#         #           VERTEX              TEXCOORD  NORMAL
-#                     [0.0 - wd, 0.0 - hd, 0.0, 0.0, 0.0, 0.0, 1.0],
-#                     [0.0 + wd, 0.0 - hd, 1.0, 0.0, 0.0, 0.0, 1.0],
-#                     [0.0 + wd, 0.0 + hd, 1.0, 1.0, 0.0, 0.0, 1.0],
-#                     [0.0 - wd, 0.0 + hd, 0.0, 1.0, 0.0, 0.0, 1.0]
-#         ]
-#
-#         self.message_VBO = VertexBuffer(array(vertices, dtype=float32))
+        message['normal'] = array([NORMAL] * 4, dtype=float32)
+
+        # Instatiate the Vertex Buffer Objects using VertexBuffer
+        self.__fill_VBO(self.message_VBO, self.__layout_VBO(message))
 
     def __stimuli_VBO(self, scaleX, scaleY):
         """
         Create the Vertex Buffer Objects for stimuli display
-        """
-        # Initiate the VBOs pertaining to the stimuli texture
-        self.stimuli_VBO['vertex'] = []
-        self.stimuli_VBO['texcoord'] = []
-        self.stimuli_VBO['normal'] = []
 
+        The finished buffers are stored in the mesh cache, so on later
+        launches they are memory-mapped from disk instead of generated
+        """
         t0 = time()
-        # Iterate through the points, moving up by the preset value:
-        # STEP_SIZE
-        for X in xrange(0, WIDTH - STEP_SIZE + 1, STEP_SIZE):
-            for Y in xrange(0, HEIGHT - STEP_SIZE + 1, STEP_SIZE):
-
-                # BOTTOM LEFT CORNER
-                x, y, vertX, vertY = get_coords(X, Y, scaleX, scaleY)
-                self.stimuli_VBO['vertex'].append([vertX, vertY])
-                self.stimuli_VBO['texcoord'].append([x, y])
-
-                # BOTTOM RIGHT CORNER
-                x, y, vertX, vertY = get_coords(X + STEP_SIZE, Y,
-                                                scaleX, scaleY)
-                self.stimuli_VBO['vertex'].append([vertX, vertY])
-                self.stimuli_VBO['texcoord'].append([x, y])
-
-                # TOP RIGHT CORNER
-                x, y, vertX, vertY = get_coords(X + STEP_SIZE,
-                                                Y + STEP_SIZE,
-                                                scaleX, scaleY)
-                self.stimuli_VBO['vertex'].append([vertX, vertY])
-                self.stimuli_VBO['texcoord'].append([x, y])
-
-                # TOP LEFT CORNER
-                x, y, vertX, vertY = get_coords(X, Y + STEP_SIZE,
-                                                scaleX, scaleY)
-                self.stimuli_VBO['vertex'].append([vertX, vertY])
-                self.stimuli_VBO['texcoord'].append([x, y])
-
-                for i in range(0, 4):
-                    self.stimuli_VBO['normal'].append([0.0, 0.0, 1.0])
+        if self.mesh_mode == 'procedural':
+            self.__procedural_VBO(scaleX, scaleY)
+            return
+
+        if self.mesh_per_map:
+            # Each of the height maps has a mesh of its own, so the mesh
+            # is also cached by the content of the maps it is built from
+            self.stimuli_meshes = []
+            for index in range(len(HEIGHTMAPS)):
+                key = self.__mesh_key(scaleX, scaleY,
+                                      *self.__map_params(index))
+                self.stimuli_meshes.append(
+                    self.__cached_VBO(key, self.__build_stimuli, scaleX,
+                                      scaleY, index))
+        else:
+            key = self.__mesh_key(scaleX, scaleY)
+            self.stimuli_VBO, self.stimuli_points = \
+                self.__cached_VBO(key, self.__build_stimuli, scaleX, scaleY)
+
+        if self.tiled:
+            self.__tile_VBO(scaleX, scaleY)
+        self.select_stimuli(0)
+
+        print 'Preparing the VBOs took %s seconds' % get_time(t0, time())
+
+    def __mesh_key(self, *params):
+        """
+        Make the key for the mesh cache from params, along with all of
+        the settings that have an effect on the finished buffers
+        """
+        return self.mesh_cache.key(WIDTH, HEIGHT, STEP_SIZE,
+                                   VERTEX_SHADER_FILE, self.mesh_mode,
+                                   INTERLEAVED_VBO, CONSTANT_NORMAL,
+                                   self.tiled, TILE_SIZE, self.compact,
+                                   VERTEX_FORMAT, MESH_ORDER,
+                                   VERTEX_CACHE_SIZE, self.baked, *params)
+
+    def __map_params(self, index):
+        """
+        Get the parameters for the mesh cache of the mesh built from the
+        maps at index
+        """
+        params = [content_hash(HEIGHTMAPS[index])]
+        if self.mesh_mode == 'adaptive':
+            params += [ADAPTIVE_MAX_ERROR, SCALE_FACTOR, max(HEIGHT_RATIO)]
+        if self.baked:
+            params += [normalmap_key((HEIGHTMAPS[index], NORMALMAPS[index])),
+                       SCALE_FACTOR]
+        return params
+
+    def __cached_VBO(self, key, build, *args):
+        """
+        Create the Vertex Buffer Objects for a stimuli mesh, loading the
+        finished buffers from the mesh cache or otherwise building them
+        with build(*args) and storing them into the cache
+
+        Returns the Vertex Buffer Objects along with the number of points
+        to be drawn
+        """
+        buffers = self.mesh_cache.load(key)
+        if buffers is None:
+            arrays = build(*args)
+            if self.compact:
+                arrays = compact(arrays, self.vertex_format,
+                                 *self.vertex_scale)
+            buffers = self.__layout_VBO(arrays)
+            self.mesh_cache.save(key, buffers)
 
         # Instatiate the Vertex Buffer Objects using VertexBuffer
+        VBO = {}
+        self.__fill_VBO(VBO, buffers)
+
+        # The points to be drawn are the indices if the mesh is indexed,
+        # otherwise the vertices
+        if 'index' in buffers:
+            return VBO, len(buffers['index'])
+        return VBO, len(buffers.values()[0])
+
+    def select_stimuli(self, index):
+        """
+        Select the mesh for the stimulus displayed with the height map
+        at index, if each of the height maps has a mesh of its own
+        """
+        if self.mesh_per_map:
+            self.stimuli_VBO, self.stimuli_points = self.stimuli_meshes[index]
+        # The maps of the stimulus are at the same layer of each of the
+        # texture arrays
+        self.layer = index
+        # The height map sets how far each tile is displaced
+        if self.tiled:
+            self.tiles['bounds'] = self.stimuli_bounds[index]
+
+    def __tile_VBO(self, scaleX, scaleY):
+        """
+        Ready the tiles of the meshgrid to be culled, by recording the
+        range of indices of every tile and the bounding box of every tile
+        once displaced by each of the height maps, and by each of them
+        blurred for TRIAL_BLURS
+        """
+        self.tiles = {'ranges': tile_ranges(TILE_SIZE,
+                                            self.mesh_mode == 'strip')}
+
+        self.stimuli_bounds = []
+        for filename in HEIGHTMAPS:
+            key = self.__mesh_key(scaleX, scaleY, content_hash(filename),
+                                  SCALE_FACTOR, sorted(set(TRIAL_BLURS)),
+                                  'bounds')
+            arrays = self.mesh_cache.load(key)
+            if arrays is None:
+                pixels = load_array(filename)
+                # The blurred trials draw the height map blurred on the
+                # GPU, or on the CPU into 8-bit pixels, so the box of each
+                # tile must hold every one of them
+                levels = [pixels]
+                for radius in set(TRIAL_BLURS) - set([0]):
+                    levels.append(blur(pixels, radius))
+                    levels.append(blur(rint(pixels * 255).astype(uint8),
+                                       radius) / 255.0)
+                bounds = None
+                for level in levels:
+                    # Displace the height map as the vertex shader would,
+                    # HEIGHT_RATIO is applied by the ModelViewMatrix
+                    heights = shader_luminance(level) * SCALE_FACTOR
+                    level_bounds = tile_bounds(heights, scaleX, scaleY,
+                                               TILE_SIZE)
+                    if bounds is None:
+                        bounds = level_bounds
+                        continue
+                    bounds[:, 0, 2] = minimum(bounds[:, 0, 2],
+                                              level_bounds[:, 0, 2])
+                    bounds[:, 1, 2] = maximum(bounds[:, 1, 2],
+                                              level_bounds[:, 1, 2])
+                arrays = {'bounds': bounds}
+                self.mesh_cache.save(key, arrays)
+            self.stimuli_bounds.append(arrays['bounds'])
+
+    def __procedural_VBO(self, scaleX, scaleY):
+        """
+        Ready the stimuli for display with the meshgrid derived from
+        gl_VertexID in the vertex shader
+        """
+        # The vertex shader does not read the attributes, but nothing
+        # would be drawn in the compatibility profile with attribute 0
+        # disabled. A vertex for each instance, read for every vertex as
+        # it only advances once per instance, keeps it enabled
         self.stimuli_VBO['vertex'] = \
-        VertexBuffer(array(self.stimuli_VBO['vertex'], dtype=float32))
-        self.stimuli_VBO['texcoord'] = \
-        VertexBuffer(array(self.stimuli_VBO['texcoord'], dtype=float32))
-        self.stimuli_VBO['normal'] = \
-        VertexBuffer(array(self.stimuli_VBO['normal'], dtype=float32))
+            VertexBuffer(zeros((self.instances, 2), dtype=float32),
+                         divisor=1)
 
-        print 'Preparing the VBOs took %s seconds' % get_time(t0, time())
+        self.grid = {'scale': (scaleX, scaleY)}
+        self.set_grid(STEP_SIZE)
 
-#     def __stimuli_VBO2(self):
-#         """
-#         Create the Vertex Buffer Objects for stimuli display
-#         """
-#         vertices = []
-#         indices = []
-#         next_column = HEIGHT / STEP_SIZE + 1
-#
-#         # Iterate through the points, moving up by the preset value:
-#         # STEP_SIZE
-#         for X in xrange(0, WIDTH + 1, STEP_SIZE):
-#             for Y in xrange(0, HEIGHT + 1, STEP_SIZE):
-#                 # Handle the VERTEX BUFFER OBJECT
-#                 x, y, vertX, vertY = self.__get_coords(X, Y)
-#                 vertices.append(
-#                 #         VERTEX        TEXCOORD
-#                          [vertX, vertY, x, y,
-#                 #         NORMAL
-#                           0.0, 0.0, 1.0]
-#                 )
-#
-#                 # Handle the ELEMENT BUFFER OBJECT
-#                 index_x = X / STEP_SIZE
-#                 index_y = Y / STEP_SIZE
-#                 origin = index_x + index_y
-#
-#                 indices.append(
-#                 #               BOTTOM LEFT CORNER
-#                                [origin,
-#                 #               BOTTOM RIGHT CORNER
-#                                 origin + next_column,
-#                 #               TOP RIGHT CORNER
-#                                 origin + next_column + 1,
-#                 #               TOP LEFT CORNER
-#                                 origin + 1
-#                                ]
-#                 )
-#
-#         self.stimuli_VBO = VertexBuffer(array(vertices, dtype=float32))
-#         self.indices_VBO = VertexBuffer(array(indices, dtype=int32))
+    def set_grid(self, step):
+        """
+        Set the width and height of each quadrilateral of the procedural
+        meshgrid, which is passed to the shaders along with the other
+        variables before the next stimulus is displayed
+        """
+        columns, rows = grid_cells(step)
+        self.grid['cells'] = (columns, rows)
+        self.grid['step'] = (step / float(WIDTH), step / float(HEIGHT))
+
+        # Every quadrilateral is drawn as 2 triangles
+        self.stimuli_points = columns * rows * 6
+
+    def __build_stimuli(self, scaleX, scaleY, index=0):
+        """
+        Build the vertices, texcoords and normals for the stimuli, as
+        well as the indices if the meshgrid is indexed
+
+        index is that of the maps the mesh is built from, if each of the
+        height maps has a mesh of its own
+        """
+        if self.mesh_mode == 'adaptive':
+            stimuli = self.__build_adaptive(HEIGHTMAPS[index], scaleX,
+                                            scaleY)
+        elif self.mesh_mode == 'quads':
+            # Build the vertices, texcoords and normals for every corner
+            # of every quadrilateral in a single vectorized pass
+            stimuli = build_quads(scaleX, scaleY)
+        else:
+            # Build the vertices, texcoords and normals for every vertex
+            # of the meshgrid, each of which is stored only once
+            stimuli = build_grid(scaleX, scaleY)
+            # Build the indices for the chosen primitive, one tile after
+            # another if the tiles are to be culled
+            # The triangles are drawn in MESH_ORDER, to reuse the vertices
+            # shared by nearby triangles from the vertex cache
+            if self.tiled:
+                stimuli['index'] = tile_indices(TILE_SIZE,
+                                                self.mesh_mode == 'strip',
+                                                order=MESH_ORDER)
+            elif self.mesh_mode == 'strip':
+                stimuli['index'] = strip_indices()
+            else:
+                stimuli['index'] = triangle_indices(order=MESH_ORDER)
+
+        # Displace the vertices and read their normals from the maps,
+        # instead of in the vertex shader
+        if self.baked:
+            normalmap = load_normalmap((HEIGHTMAPS[index], NORMALMAPS[index]))
+            stimuli = bake(stimuli, load_array(HEIGHTMAPS[index]),
+                           unit_scale(normalmap), SCALE_FACTOR)
+        return stimuli
+
+    def __build_adaptive(self, filename, scaleX, scaleY):
+        """
+        Build the vertices, texcoords, normals and indices of the mesh
+        that is only dense where the height map in filename curves
+        """
+        # Displace the height map as the vertex shader would, at the
+        # largest of the height ratios
+        heights = shader_luminance(load_array(filename)) * SCALE_FACTOR * \
+            max(HEIGHT_RATIO)
+        return build_adaptive(heights, ADAPTIVE_MAX_ERROR, scaleX, scaleY,
+                              order=MESH_ORDER)
+
+    def __layout_VBO(self, arrays):
+        """
+        Lay out the vertices, texcoords and normals held in arrays into
+        the arrays to be uploaded to each of the Vertex Buffer Objects
+        """
+        names = ['vertex', 'texcoord']
+        # The normal only needs a buffer if it is not set as a constant,
+        # the baked normals are read from the normal map
+        if not CONSTANT_NORMAL or self.baked:
+            names.append('normal')
+
+        buffers = {}
+        if INTERLEAVED_VBO:
+            # Store all the attributes in a single buffer
+            buffers['interleaved'] = interleave(arrays, names)
+        else:
+            # Store each of the attributes in a buffer of its own
+            for name in names:
+                buffers[name] = arrays[name]
+
+        # The indices are always kept in a buffer of their own
+        if 'index' in arrays:
+            buffers['index'] = arrays['index']
+        return buffers
+
+    def __fill_VBO(self, VBO, buffers):
+        """
+        Instantiate the Vertex Buffer Objects for the arrays laid out by
+        __layout_VBO, storing them into VBO by attribute name
+        """
+        for name, data in buffers.items():
+            if name == 'index':
+                VBO['index'] = ElementBuffer(data)
+                continue
+
+            vbo = VertexBuffer(data)
+            # An interleaved buffer is shared by each of its attributes
+            for field in data.dtype.names or [name]:
+                VBO[field] = vbo
+
+    def __bind_VBO(self, VBO):
+        """
+        Bind the Vertex Buffer Objects held in VBO to their attributes,
+        using the stride and offset of each attribute in its buffer
+        """
+        shader = ENABLE_SHADER and GLSL_VERSION == 330
+        for name, attribute, size in self.attributes:
+            # If the attribute is not held in a buffer, it is set as a
+            # constant. Only the normal has a meaningful constant value,
+            # the other attributes are not read from when left out
+            if name not in VBO:
+                if not shader:
+                    if name == 'normal':
+                        set_constant_normal(NORMAL)
+                elif name == 'normal':
+                    set_constant_attribute(attribute, NORMAL)
+                else:
+                    set_constant_attribute(attribute, [0.0] * size)
+                continue
+
+            vbo = VBO[name]
+            offset = vbo.offsets.get(name, 0)
+            size, var_type, normalized = vbo.format(name)
+            if shader:
+                vbo.bind_attribute(attribute, size, var_type, vbo.stride,
+                                   offset, normalized)
+            elif name == 'vertex':
+                vbo.bind_vertices(size, var_type, vbo.stride, offset)
+            elif name == 'texcoord':
+                vbo.bind_texcoords(size, var_type, vbo.stride, offset)
+            else:
+                vbo.bind_normals(var_type, vbo.stride, offset)
 
     def bind_message(self):
         """
@@ -435,40 +773,32 @@ class Render(object):
         messages and the fixation point
         """
         # Bind all the Vertex Buffer Objects
-        if ENABLE_SHADER and GLSL_VERSION == 330:
-            self.message_VBO['vertex'].bind_attribute(0, 2, GL_FLOAT)
-            self.message_VBO['texcoord'].bind_attribute(1, 2, GL_FLOAT)
-            self.message_VBO['normal'].bind_attribute(2, 3, GL_FLOAT)
-        else:
-            self.message_VBO['vertex'].bind_vertices(2, GL_FLOAT)
-            self.message_VBO['texcoord'].bind_texcoords(2, GL_FLOAT)
-            self.message_VBO['normal'].bind_normals(GL_FLOAT)
+        self.__bind_VBO(self.message_VBO)
 
     def bind_stimuli(self):
         """
         Bind all the Vertex Buffer Objects necessary for displaying the
         stimuli
         """
-        # Bind all the Vertex Buffer Objects
-        if ENABLE_SHADER and GLSL_VERSION == 330:
-            self.stimuli_VBO['vertex'].bind_attribute(0, 2, GL_FLOAT)
-            self.stimuli_VBO['texcoord'].bind_attribute(1, 2, GL_FLOAT)
-            self.stimuli_VBO['normal'].bind_attribute(2, 3, GL_FLOAT)
-        else:
-            self.stimuli_VBO['vertex'].bind_vertices(2, GL_FLOAT)
-            self.stimuli_VBO['texcoord'].bind_texcoords(2, GL_FLOAT)
-            self.stimuli_VBO['normal'].bind_normals(GL_FLOAT)
+        # Bind all the Vertex Buffer Objects, along with the offset of
+        # each position of the stimuli when they are instanced
+        VBO = dict(self.stimuli_VBO)
+        if self.instanced:
+            VBO['offset'] = self.instance_VBO
+        self.__bind_VBO(VBO)
+
+        # Bind the indices if the meshgrid is indexed
+        if 'index' in self.stimuli_VBO:
+            self.stimuli_VBO['index'].bind()
 
     def unbind_all(self):
         if hasattr(self, 'message_VBO'):
-            self.message_VBO['vertex'].unbind()
-            self.message_VBO['texcoord'].unbind()
-            self.message_VBO['normal'].unbind()
+            for vbo in self.message_VBO.values():
+                vbo.unbind()
 
         if hasattr(self, 'stimuli_VBO'):
-            self.stimuli_VBO['vertex'].unbind()
-            self.stimuli_VBO['texcoord'].unbind()
-            self.stimuli_VBO['normal'].unbind()
+            for vbo in self.stimuli_VBO.values():
+                vbo.unbind()
 
 # ------------------------------------------------------------------
 # HANDLE SHADERS
@@ -480,54 +810,152 @@ class Render(object):
         """
         # If set to use shaders, enable them accordingly
         if ENABLE_SHADER:
-            # Get the vertex shader
-            vs = VertexShader(VERTEX_SHADER_FILE)
+            # Get the vertex shader, which only transforms the vertices
+            # if the displacement mapping is baked
+            if self.baked:
+                vs = VertexShader(BAKED_VERTEX_SHADER_FILE)
+            else:
+                vs = VertexShader(VERTEX_SHADER_FILE)
             # Get the fragment shader
             fs = FragmentShader(FRAGMENT_SHADER_FILE)
+            # The shaders blurring the maps are only needed if any of the
+            # stimuli are blurred, and are linked first so that the
+            # program drawing the stimuli is left in use
+            if max(TRIAL_BLURS) and self.gpu_blur:
+                self.blur_shader = ShaderProgram(
+                    VertexShader(BLUR_VERTEX_SHADER_FILE),
+                    FragmentShader(BLUR_FRAGMENT_SHADER_FILE))
+                self.blur_shader.use()
             # Assign the shader for the program
             self.shader = ShaderProgram(vs, fs)
             # Use the shader with the program
             self.shader.use()
 
+            # The array samplers must never share a texture unit with the
+            # 2D samplers, even when the texture arrays are not used
+            if GLSL_VERSION == 330:
+                for name, unit in self.array_units:
+                    loc = glGetUniformLocation(self.shader.id, name)
+                    glUniform1i(loc, unit)
+
+    def create_texture_arrays(self, colormaps, heightmaps, normalmaps):
+        """
+        Upload the maps of all the stimuli into a texture array for each
+        type of map, each bound once to a texture unit of its own
+        """
+        if not self.texture_arrays:
+            return
+
+        t0 = time()
+        maps = [colormaps, heightmaps, normalmaps]
+        for (name, unit), images in zip(self.array_units, maps):
+            # The normalmaps are packed into the heightmaps
+            if images is None:
+                continue
+            # The texture unit of the array is passed to the shaders
+            # along with the shaders themselves
+            glActiveTexture(GL_TEXTURE0 + unit)
+            glBindTexture(GL_TEXTURE_2D_ARRAY, upload_array(images))
+
+        print 'Uploading the texture arrays took %s seconds' % \
+            get_time(t0, time())
+
+    def prefetch_textures(self, images):
+        """
+        Start uploading the textures of the images to be displayed next,
+        so that they are resident by the time they are assigned
+        """
+        if not self.async_upload:
+            return
+
+        for image in images:
+            self.texture_cache.prefetch(image)
+
+    def blur_maps(self, heightmap, normalmap, radius):
+        """
+        Blur the heightmap of the next stimulus by radius, along with the
+        normalmap so that the lighting follows the blurred surface, to be
+        bound in place of the maps by pass_to_shaders
+
+        Each map is blurred by the separable Gaussian of blur.py, along X
+        into the first of its pair of Frame Buffer Objects and then from
+        it along Y into the second, on the GPU with no file I/O
+
+        NOTE: A radius of 0 leaves the maps as they are
+        """
+        self.blur_radius = radius
+        if not radius:
+            return
+
+        t0 = time()
+        # Keep the state changed by the passes, to restore it after
+        viewport = glGetIntegerv(GL_VIEWPORT)
+        active = int(glGetIntegerv(GL_ACTIVE_TEXTURE))
+
+        glUseProgram(self.blur_shader.id)
+        glDisable(GL_DEPTH_TEST)
+        glActiveTexture(GL_TEXTURE0 + self.blur_unit)
+        loc = glGetUniformLocation(self.blur_shader.id, 'source')
+        glUniform1i(loc, self.blur_unit)
+        loc = glGetUniformLocation(self.blur_shader.id, 'radius')
+        glUniform1f(loc, radius)
+        step = glGetUniformLocation(self.blur_shader.id, 'texel_step')
+
+        # The normalmap is packed into the heightmap, if it is None
+        for name, image in [('heightmap', heightmap),
+                            ('normalmap', normalmap)]:
+            if image is None:
+                continue
+            height, width = image.shape[:2]
+            buffers = self.blur_buffers.get(name)
+            if buffers is None or buffers[0].width != width or \
+               buffers[0].height != height:
+                buffers = [FrameBuffer(width, height) for i in range(2)]
+                self.blur_buffers[name] = buffers
+
+            # Step a texel along X on the first pass and along Y on the
+            # second
+            steps = [(1.0 / width, 0.0), (0.0, 1.0 / height)]
+            source = self.texture_cache.get(image)
+            for frame_buffer, texel_step in zip(buffers, steps):
+                frame_buffer.bind()
+                glBindTexture(GL_TEXTURE_2D, source)
+                glUniform2f(step, *texel_step)
+                glDrawArrays(GL_TRIANGLE_STRIP, 0, 4)
+                # The next pass blurs the result of this one
+                source = frame_buffer.texture
+            buffers[-1].unbind()
+
+        glViewport(*viewport)
+        glActiveTexture(active)
+        glEnable(GL_DEPTH_TEST)
+        glUseProgram(self.shader.id)
+
+        print 'Blurring the maps took %s seconds' % get_time(t0, time())
+
     def pass_to_shaders(self, program, process_stimuli, colormap, heightmap,
                         normalmap):
         """
         Pass variables to shaders
         """
         # ----------------------------------------------------------
-        # HANDLE DISPLACEMENT MAPPING VARIABLES
+        # HANDLE TEXTURE ARRAYS
         # ----------------------------------------------------------
 
-        # Get the texture for colormap
-        colormap = colormap.get_texture()
-        # Work on GL_TEXTURE0
-        glActiveTexture(GL_TEXTURE0)
-        # Bind the colormap
-        glBindTexture(colormap.target, colormap.id)
-        # Get the location of the colormap and pass it to the shader
-        loc = glGetUniformLocation(program.id, 'colormap')
-        glUniform1i(loc, 0)
-
-        # Work on GL_TEXTURE_1
-        glActiveTexture(GL_TEXTURE1)
-        # Get the location of the heightmap
-        loc = glGetUniformLocation(program.id, 'heightmap')
-        # If the use of heightmaps is enabled, this must mean we are
-        # rendering the stimuli
-        if process_stimuli:
-            # Get the texture for heightmap
-            heightmap = heightmap.get_texture()
-            # Bind the displacement map
-            glBindTexture(heightmap.target, heightmap.id)
-        # Pass the variable colormap to the loc for heightmap in
-        # the vertex shader
-        glUniform1i(loc, 1)
-
-        glActiveTexture(GL_TEXTURE2)
-        loc = glGetUniformLocation(program.id, 'normalmap')
-        normalmap = normalmap.get_texture()
-        glBindTexture(normalmap.target, normalmap.id)
-        glUniform1i(loc, 2)
+        # The maps of the stimuli are read from the texture arrays, so
+        # only the layer of the stimulus is passed
+        arrays = process_stimuli and self.texture_arrays
+        loc = glGetUniformLocation(program.id, 'texture_arrays')
+        glUniform1i(loc, arrays)
+        # The heightmap holds the normalmap too, see tools.pack_maps
+        loc = glGetUniformLocation(program.id, 'packed_maps')
+        glUniform1i(loc, process_stimuli and self.packed_maps)
+        if arrays:
+            loc = glGetUniformLocation(program.id, 'layer')
+            glUniform1i(loc, self.layer)
+        else:
+            self.__bind_maps(program, process_stimuli, colormap, heightmap,
+                             normalmap)
 
         # ----------------------------------------------------------
         # HANDLE LIGHTING VARIABLES
@@ -557,6 +985,35 @@ class Render(object):
         loc = glGetUniformLocation(program.id, 'per_pixel')
         glUniform1iv(loc, 1, PER_PIXEL)
 
+        # ----------------------------------------------------------
+        # HANDLE PROCEDURAL MESHGRID
+        # ----------------------------------------------------------
+
+        # Derive the meshgrid from gl_VertexID only for the stimuli
+        procedural = process_stimuli and self.mesh_mode == 'procedural'
+        loc = glGetUniformLocation(program.id, 'procedural_grid')
+        glUniform1i(loc, procedural)
+
+        if procedural:
+            loc = glGetUniformLocation(program.id, 'grid_cells')
+            glUniform2i(loc, *self.grid['cells'])
+            loc = glGetUniformLocation(program.id, 'grid_step')
+            glUniform2f(loc, *self.grid['step'])
+            loc = glGetUniformLocation(program.id, 'grid_scale')
+            glUniform2f(loc, *self.grid['scale'])
+
+        # ----------------------------------------------------------
+        # HANDLE VERTEX FORMATS
+        # ----------------------------------------------------------
+
+        # Scale the vertices stored as normalized shorts, which are only
+        # used for the stimuli
+        loc = glGetUniformLocation(program.id, 'vertex_scale')
+        if process_stimuli:
+            glUniform2f(loc, *self.vertex_scale)
+        else:
+            glUniform2f(loc, 1.0, 1.0)
+
         # ----------------------------------------------------------
         # HANDLE VERTEX BUFFER OBJECTS
         # ----------------------------------------------------------
@@ -583,6 +1040,53 @@ class Render(object):
             #                       self.message_stride * 2)
         # glEnableVertexAttribArray(loc)
 
+    def __bind_maps(self, program, process_stimuli, colormap, heightmap,
+                    normalmap):
+        """
+        Bind the maps of the stimulus as 2D textures, uploading them if
+        they are not resident
+        """
+        # Work on GL_TEXTURE0
+        glActiveTexture(GL_TEXTURE0)
+        # Bind the colormap, uploading it if it is not resident
+        glBindTexture(GL_TEXTURE_2D, self.texture_cache.get(colormap))
+        # Get the location of the colormap and pass it to the shader
+        loc = glGetUniformLocation(program.id, 'colormap')
+        glUniform1i(loc, 0)
+
+        # Work on GL_TEXTURE_1
+        glActiveTexture(GL_TEXTURE1)
+        # Get the location of the heightmap
+        loc = glGetUniformLocation(program.id, 'heightmap')
+        # If the use of heightmaps is enabled, this must mean we are
+        # rendering the stimuli
+        if process_stimuli:
+            # Bind the displacement map
+            glBindTexture(GL_TEXTURE_2D,
+                          self.__map_texture('heightmap', heightmap))
+        # Pass the variable colormap to the loc for heightmap in
+        # the vertex shader
+        glUniform1i(loc, 1)
+
+        # There is no normalmap of its own if it is packed into the
+        # heightmap
+        if normalmap is None:
+            return
+        glActiveTexture(GL_TEXTURE2)
+        loc = glGetUniformLocation(program.id, 'normalmap')
+        glBindTexture(GL_TEXTURE_2D,
+                      self.__map_texture('normalmap', normalmap))
+        glUniform1i(loc, 2)
+
+    def __map_texture(self, name, image):
+        """
+        Get the texture of the map of the stimulus, the texture it was
+        blurred into by blur_maps if it is blurred, otherwise its own
+        """
+        if self.blur_radius and name in self.blur_buffers:
+            return self.blur_buffers[name][-1].texture
+        return self.texture_cache.get(image)
+
 # ------------------------------------------------------------------
 # HANDLE TEXTURE
 # ------------------------------------------------------------------
@@ -590,21 +1094,13 @@ class Render(object):
     def assign_texture(self, texture, width=WIDTH, height=HEIGHT):
         """
         Assign the texture for viewing in OpenGL
+
+        The texture is only uploaded the first time it is assigned, or
+        once it has been deleted from the texture cache, otherwise it
+        is only bound
         """
         # Bind the texture
-        print texture.get_texture().id
-        glBindTexture(GL_TEXTURE_2D, texture.get_texture().id)
-        # Assign 2D texture
-        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, width, height, 0, GL_RGBA,
-                     GL_UNSIGNED_BYTE, pixel_access(texture))
-
-        # Settings for use of the texture
-        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
-        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
-        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
-
-        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-        glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+        glBindTexture(GL_TEXTURE_2D, self.texture_cache.get(texture))
 
         glTexEnvf(GL_TEXTURE_ENV, GL_TEXTURE_ENV_MODE, GL_DECAL)
 
@@ -641,6 +1137,11 @@ class Render(object):
 
             if not count:
                 rot = deg_to_rad(-rot)
+            # Every position of the stimuli is drawn by the same draw
+            # call, offset from the center by its instance
+            if render_stimuli and self.instanced:
+                self.__set_instances(rot)
+                translate = [(0.0, 0.0)]
             for x, y in translate:
                 self.translation['Z'] = STIMULI_DEPTH
                 self.translation['X'] = x * SCALE_X
@@ -667,6 +1168,22 @@ class Render(object):
                 else:
                     self.__draw_message()
 
+    def __set_instances(self, rot):
+        """
+        Set the offset of each position of the stimuli from the center,
+        in the same way as the translation of each position is set by
+        draw for the slant rot
+        """
+        # The offsets only change along with the slant
+        if rot == self.instance_rot:
+            return
+        self.instance_rot = rot
+
+        for i, (x, y) in enumerate(self.translate_stimuli):
+            self.instance_offsets[i] = [x * SCALE_X, y * cos(rot) * SCALE_Y,
+                                        y * sin(rot) * SCALE_Y]
+        self.instance_VBO.update(self.instance_offsets)
+
     def __pass_matrix(self):
         loc = glGetUniformLocation(self.shader.id, 'ProjectionMatrix')
         glUniformMatrix4fv(loc, 1, GL_FALSE, self.projection.matrix)
@@ -675,7 +1192,14 @@ class Render(object):
         glUniformMatrix4fv(loc, 1, GL_FALSE, self.modelview.matrix)
 
         loc = glGetUniformLocation(self.shader.id, 'NormalMatrix')
-        glUniformMatrix3fv(loc, 1, GL_FALSE, self.modelview.normal)
+        if self.baked:
+            # The baked vertex shader is passed the inverse transpose of
+            # the NormalMatrix, as OpenGL reads it, instead of finding it
+            # for every vertex
+            normal = inv(self.modelview.normal).T.astype(float32)
+            glUniformMatrix3fv(loc, 1, GL_FALSE, normal)
+        else:
+            glUniformMatrix3fv(loc, 1, GL_FALSE, self.modelview.normal)
 
     def __print_matrices(self):
         print 'GL_PROJECTION_MATRIX:'
@@ -725,15 +1249,74 @@ class Render(object):
         """
         Draw the stimulus
         """
-        points = (WIDTH / STEP_SIZE) * (HEIGHT / STEP_SIZE) * 4
-        # If set to render solid, render the solid version
-        if RENDER_SOLID:
-            # Start drawing the quadrilateral
-            glDrawArrays(GL_QUADS, 0, points)
-        # Else produce wireframe
+        points = self.stimuli_points
+        # If the quadrilaterals are not set to render solid, draw lines
+        # to indicate the wireframe
+        if self.mesh_mode == 'quads' and not RENDER_SOLID:
+            self.__draw_arrays(GL_LINES, points)
+            return
+
+        # If not set to render solid, produce the wireframe
+        if not RENDER_SOLID:
+            glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
+
+        # If the meshgrid is indexed, draw it through the indices
+        if self.tiled:
+            # Only draw the tiles within the view, each run of tiles
+            # following on from one another in a single draw call
+            for first, count in self.__visible_runs():
+                self.__draw_elements(first, count)
+        elif 'index' in self.stimuli_VBO:
+            self.__draw_elements(0, points)
+        else:
+            self.__draw_arrays(self.stimuli_primitive, points)
+
+        if not RENDER_SOLID:
+            glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
+
+    def __visible_runs(self):
+        """
+        Get the runs of indices of the tiles within the view of the eye
+        being drawn, using the matrices last passed to the shaders
+        """
+        # The matrices are stored column by column, so as row vectors
+        # the vertices are taken to clip coordinates by their product
+        modelview = self.modelview.matrix.reshape(4, 4)
+        projection = self.projection.matrix.reshape(4, 4)
+
+        # A tile is drawn if it is within the view at any of the
+        # positions of the stimuli drawn by the same draw call
+        visible = zeros(len(self.tiles['ranges']), dtype=bool)
+        for offset in self.instance_offsets:
+            matrix = modelview.copy()
+            matrix[3, :3] += offset
+            visible |= visible_tiles(self.tiles['bounds'],
+                                     dot(matrix, projection))
+        return visible_runs(self.tiles['ranges'], visible)
+
+    def __draw_elements(self, first, count):
+        """
+        Draw count of the indices of the stimuli from the index first,
+        once for every instance if the stimuli are instanced
+        """
+        # Every GL_UNSIGNED_INT index takes up 4 bytes
+        if self.instanced:
+            glDrawElementsInstanced(self.stimuli_primitive, count,
+                                    GL_UNSIGNED_INT, pointer(first * 4),
+                                    self.instances)
+        else:
+            glDrawElements(self.stimuli_primitive, count, GL_UNSIGNED_INT,
+                           pointer(first * 4))
+
+    def __draw_arrays(self, primitive, count):
+        """
+        Draw count of the vertices of the stimuli as primitive, once for
+        every instance if the stimuli are instanced
+        """
+        if self.instanced:
+            glDrawArraysInstanced(primitive, 0, count, self.instances)
         else:
-            # Draw lines to indicate the wireframe
-            glDrawArrays(GL_LINES, 0, points)
+            glDrawArrays(primitive, 0, count)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,7 @@
+from multiprocessing import cpu_count
+
 from os import listdir, makedirs
-from os.path import exists
+from os.path import basename, exists, join
 
 from sys import exit
 
@@ -13,12 +15,25 @@ def get_images(directory):
     Get all the images of a certain type from a directory
     """
     images = []
-    # For all files in the directory
-    for files in listdir(directory):
+    # For all files in the directory, sorted so that the maps of each
+    # type are listed in the same order
+    for files in sorted(listdir(directory)):
         # If the filename ends with img_type, it is our required images
         if files.endswith('.jpg') or files.endswith('.png'):
             # Join it to the list of stimuli images
-            images.append(directory + files)
+            images.append(join(directory, files))
+    return images
+
+
+def match_images(filenames, directory):
+    """
+    Get the image in directory with the same name as each of filenames,
+    or None for those with no image of the same name
+    """
+    images = []
+    for filename in filenames:
+        image = join(directory, basename(filename))
+        images.append(image if exists(image) else None)
     return images
 
 
@@ -39,7 +54,15 @@ EXP_NAME = '3D_SLANT_RELIEF'
 img_dir = '../img/stimuli'
 COLORMAPS = get_images(img_dir + '/colormaps')
 HEIGHTMAPS = get_images(img_dir + '/heightmaps')
-NORMALMAPS = get_images(img_dir + '/normalmaps')
+# The normalmap of each of the HEIGHTMAPS, of the same name, or None if
+# it is to be built from the heightmap by normalmaps.py
+NORMALMAPS = match_images(HEIGHTMAPS, img_dir + '/normalmaps')
+# Number of the stimuli images of each type kept loaded in memory at
+# once, the others are loaded as they are needed
+STIMULI_WINDOW = 8
+# Number of threads decoding images in parallel whenever several images
+# are needed at once, such as the messages at startup
+DECODE_WORKERS = cpu_count()
 
 # If the number of stimuli images of each type are not equal
 # We report an error
@@ -59,6 +82,20 @@ DATA_DIR = '../data'
 if not exists(DATA_DIR):
     makedirs(DATA_DIR)
 
+# Directory in which to store generated assets, such as the meshgrid,
+# so that they are not generated again on every launch
+CACHE_DIR = '../cache'
+# Set to False to always generate the assets from scratch
+ENABLE_CACHE = True
+
+# Bundle of all the images, already decoded, written by pack_bundle.py
+# as numbered versions of this filename, of which the latest is used
+# The images found in it are memory-mapped instead of decoded, the
+# others are decoded as usual
+STIMULI_BUNDLE = '../img/stimuli.bundle'
+# Set to False to always decode the images
+ENABLE_BUNDLE = True
+
 STIMULI_ONLY = False
 # Use this if loading the Vertex Buffer Object from a file
 # VBO_FILE = 'coordinates.py'
@@ -84,14 +121,24 @@ PRACTICE_STIMULI = 10
 #     2. Possible slants, set by the variable POSSIBLE_SLANTS
 #     3. Ratio to which the displacement mapping is scaled to in the
 #        Z-axis, set by the variable HEIGHT_RATIO
+#     4. Radius of the blur of the heightmap, set by the variable
+#        TRIAL_BLURS
 #
 # The resulting number of stimuli is calculated by the following equation:
-# EXP_STIMULI = len(COLORMAPS) * len(POSSIBLE_SLANTS) * len(HEIGHT_RATIO) * STIMULI_REPETITION
+# EXP_STIMULI = len(COLORMAPS) * len(POSSIBLE_SLANTS) * len(HEIGHT_RATIO) * len(TRIAL_BLURS) * STIMULI_REPETITION
 STIMULI_REPETITION = 1
 # Set the slants made available to experiment
 # POSSIBLE_SLANTS = [5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60]
 # Comment this out for the real experiment
 POSSIBLE_SLANTS = [60]
+# Set the radii in pixels of the Gaussian blur of the heightmap made
+# available to experiment, 0 for the heightmap as it is
+# NOTE: The heightmap is blurred along with the normalmap, on the GPU
+#       while the fixation point is displayed if GPU_BLUR is set,
+#       otherwise on the CPU by blur.py into the asset cache
+#       Not used with TEXTURE_ARRAYS or BAKED_GEOMETRY, which do not
+#       read the maps from 2D textures
+TRIAL_BLURS = [0]
 
 SCREEN_WIDTH = 59.5
 SCREEN_HEIGHT = 33.8
@@ -102,8 +149,8 @@ SCREEN_HEIGHT = 33.8
 # Set to True if the images have been preprocessed, ie. the images
 # have already been blurred
 # Otherwise, the images are blurred in the background as participant
-# information is collected
-# DEPRECATED
+# information is collected, by blur.py into the asset cache
+# NOTE: The blurred images are otherwise built when first used
 PREPROCESSED_IMAGES = True
 
 # Fill in wiremesh and make solid
@@ -113,8 +160,10 @@ RENDER_SOLID = True
 
 # Choose the variety of Gaussian Blurred height maps to be used in
 # the experiment
-# DEPRECATED
 GAUSSIAN_BLURS = [2, 4, 8]
+# Number of threads blurring an image with each of the GAUSSIAN_BLURS
+# in parallel
+BLUR_WORKERS = cpu_count()
 
 # Width of all the stimuli images
 WIDTH = 512
@@ -126,12 +175,87 @@ HEIGHT = 512
 STEP_SIZE = 1
 # Ratio to which the map is scaled in the Z axis
 HEIGHT_RATIO = [0.06, 0.08]
+# Factor by which the grey value of the height map is scaled in the Z
+# axis, before HEIGHT_RATIO is applied
+# NOTE: This must match SCALE_FACTOR in the vertex shader
+SCALE_FACTOR = 15.0
+# Height ratio at which the normalmaps missing from the normalmaps
+# directory are built, as a single normalmap is used for every ratio
+NORMALMAP_RATIO = max(HEIGHT_RATIO)
+
+# Procedural Voronoi stimuli, generated by voronoi.py into the asset
+# cache, each from a seed of its own
+# Number of Voronoi cells along each side of the stimuli, as a grid of
+# seeds each jittered within the middle VORONOI_JITTER of its cell
+VORONOI_CELLS = 13
+VORONOI_JITTER = 0.6
+# Width in pixels of the gaps between the cells, and the distance in
+# pixels over which the corners of the cells are rounded
+VORONOI_GAP = 2.0
+VORONOI_ROUNDING = 4.0
+# Mean and standard deviation of the grey values of the colormap within
+# the cells, the gaps between them being black
+VORONOI_GREY = (189.0, 27.0)
+# Number of stimuli generated by running voronoi.py, and the number of
+# processes generating them in parallel
+VORONOI_STIMULI = 1000
+VORONOI_WORKERS = cpu_count()
+# Display the Voronoi stimuli of seeds 0 to VORONOI_STIMULI - 1 in place
+# of COLORMAPS, HEIGHTMAPS and NORMALMAPS, loaded from the asset cache
+# or otherwise generated as they are needed
+# NOTE: Not used with the meshes built from the heightmaps, with
+#       ADAPTIVE_MESH, BAKED_GEOMETRY or FRUSTUM_CULLING
+VORONOI_SOURCE = False
+
+# Choose how the meshgrid for the stimuli is stored and drawn
+#     'quads'     - Unindexed GL_QUADS, every grid vertex is stored once
+#                   for each quadrilateral that shares it
+#     'triangles' - Indexed GL_TRIANGLES, every grid vertex is stored once
+#     'strip'     - Indexed GL_TRIANGLE_STRIP, one strip per row joined
+#                   with primitive restart, every grid vertex is stored once
+# NOTE: 'strip' requires OpenGL 3.1, 'triangles' is used in its place
+#       when GLSL_VERSION is 130
+MESH_MODE = 'quads'
+# Derive the meshgrid for the stimuli from gl_VertexID in the vertex
+# shader, so no Vertex Buffer Object is needed for it and MESH_MODE is
+# not used
+# NOTE: Requires GLSL_VERSION to be 330
+PROCEDURAL_GRID = False
+# Build a mesh for each of the HEIGHTMAPS that is only dense where the
+# height map curves, instead of the uniformly dense meshgrid
+# NOTE: The mesh is drawn as indexed GL_TRIANGLES and MESH_MODE is
+#       not used
+ADAPTIVE_MESH = False
+# Largest difference in height allowed between the adaptive mesh and
+# the uniformly dense meshgrid, at the largest of the HEIGHT_RATIO
+ADAPTIVE_MAX_ERROR = 0.05
+# Split the meshgrid into tiles and skip drawing, for each eye, the
+# tiles that are entirely outside of the view
+# NOTE: Requires GLSL_VERSION to be 330, only used with MESH_MODE
+#       'triangles' or 'strip'
+FRUSTUM_CULLING = False
+# Width and height of each tile in quadrilaterals of the meshgrid
+TILE_SIZE = 64
+# Order in which the triangles of the meshgrid are drawn, so that the
+# vertices shared by nearby triangles are reused from the vertex cache
+#     'column'  - Column by column, as the meshgrid is numbered
+#     'morton'  - Along the Z-order curve over the quadrilaterals
+#     'forsyth' - Greedily by the vertex cache, slow to build but cached
+# NOTE: Only used with MESH_MODE 'triangles' and the adaptive mesh
+#       Run mesh.py to compare the average cache miss ratio of each
+MESH_ORDER = 'column'
+# Number of vertices assumed to be held by the vertex cache
+VERTEX_CACHE_SIZE = 32
 
 # Size by which to scale the meshgrid for the stimuli
 # This will be applied to the vertices passed to the Vertex Buffer Object
 SCALE_X = 30.00
 SCALE_Y = 30.00
 
+# Display the stimulus at each of the 12 positions of the grid set in
+# Render, instead of only at the center of the screen
+MULTI_STIMULI = False
+
 STIMULI_DEPTH = -3.0
 
 
@@ -154,11 +278,95 @@ elif GLSL_VERSION == 330:
     FRAGMENT_SHADER_FILE = 'shaders/fragment330.c'
     STIMULI_DEPTH = -3.0
 
+# Bake the displacement mapping into the Vertex Buffer Objects of the
+# stimuli on the CPU, a mesh for each of the HEIGHTMAPS, and draw them
+# with a vertex shader that only transforms them
+# NOTE: Requires GLSL_VERSION to be 330, not used with PROCEDURAL_GRID
+BAKED_GEOMETRY = False
+BAKED_VERTEX_SHADER_FILE = 'shaders/vertex330_baked.c'
+
+# Set filename for the shaders blurring the heightmap and normalmap of
+# the stimuli for TRIAL_BLURS, a pass along each axis drawn into a pair
+# of Frame Buffer Objects
+BLUR_VERTEX_SHADER_FILE = 'shaders/vertex330_blur.c'
+BLUR_FRAGMENT_SHADER_FILE = 'shaders/fragment330_blur.c'
+# Blur the maps of the stimuli for TRIAL_BLURS on the GPU with the
+# shaders above, otherwise use the maps blurred on the CPU by blur.py
+# NOTE: Requires GLSL_VERSION to be 330
+GPU_BLUR = False
+
 # Use VertexAttribPointer instead of VertexPointer, TexCoordPointer
 # and NormalPointer
 # DEPRECATED
 # USE_ATTRIB_POINTER = True
 
+# Interleave the vertices, texcoords and normals into a single Vertex
+# Buffer Object, instead of using one Vertex Buffer Object for each
+INTERLEAVED_VBO = False
+# Set the normal, which is the same for every vertex, as a constant
+# vertex attribute instead of storing it once per vertex
+CONSTANT_NORMAL = False
+# Store the attributes of the stimuli in compact types instead of
+# floats, the texcoords as normalized unsigned shorts and the normals
+# packed into a single 10_10_10_2 value
+# NOTE: Requires GLSL_VERSION to be 330
+COMPACT_VBO = False
+# Type in which the vertices of the stimuli are stored by COMPACT_VBO
+#     'half'  - Half floats
+#     'short' - Normalized shorts, scaled back by SCALE_X and SCALE_Y
+#               in the vertex shader
+VERTEX_FORMAT = 'short'
+# Draw every position of the stimulus with a single instanced draw call,
+# reading the offset of each position from a Vertex Buffer Object
+# NOTE: Requires GLSL_VERSION to be 330
+INSTANCED_DRAWING = False
+
+# Largest amount of GPU memory in megabytes taken up by the textures
+# kept resident, beyond which the least recently used are deleted
+TEXTURE_BUDGET = 256
+# Upload the maps of all the stimuli at startup into a texture array
+# for each type of map, so that a stimulus is selected in the shaders
+# by its layer instead of by binding its textures
+# NOTE: Requires GLSL_VERSION to be 330, all the maps must be of the
+#       same width and height
+TEXTURE_ARRAYS = False
+# Use the mip chains of the colormaps, built once by mipmaps.py and
+# kept in the CACHE_DIR, so that the far side of a slanted stimulus is
+# not aliased
+# NOTE: The texture arrays do not use the mip chains
+MIPMAPS = False
+# Store the mip chains of the colormaps compressed as BC1 (DXT1), a
+# quarter of the memory of GL_RGB at the cost of some color accuracy
+# NOTE: Requires the EXT_texture_compression_s3tc extension
+TEXTURE_COMPRESSION = False
+# Upload the textures of the next stimulus during the fixation period,
+# through Pixel Buffer Objects, so that no stimulus waits on an upload
+# NOTE: Requires GLSL_VERSION to be 330
+ASYNC_UPLOAD = False
+# Number of worker threads decoding the images of the upcoming stimuli
+# for ASYNC_UPLOAD, and the number of stimuli after the next one they
+# decode ahead
+PREFETCH_WORKERS = 2
+PREFETCH_DEPTH = 2
+# Pack the heightmap and normalmap of each stimulus into a single 16-bit
+# texture, read with a single texture fetch, so that the height is not
+# limited to 256 levels
+# NOTE: Requires GLSL_VERSION to be 330, only 16-bit heightmaps have
+#       more than 256 levels of height to keep
+PACKED_MAPS = False
+
+# The heightmap can only be blurred if it is read from a 2D texture by
+# the vertex shader
+if max(TRIAL_BLURS) and (TEXTURE_ARRAYS or BAKED_GEOMETRY):
+    report_error('ERROR: TRIAL_BLURS cannot be used with TEXTURE_ARRAYS '
+                 'or BAKED_GEOMETRY')
+
+# The meshes built from the heightmaps are built from their images
+if VORONOI_SOURCE and (ADAPTIVE_MESH or BAKED_GEOMETRY or
+                       FRUSTUM_CULLING):
+    report_error('ERROR: VORONOI_SOURCE cannot be used with ADAPTIVE_MESH, '
+                 'BAKED_GEOMETRY or FRUSTUM_CULLING')
+
 # Set depth size
 DEPTH_SIZE = 24
 
@@ -12,6 +12,12 @@ in vec3 fragColor;
 uniform sampler2D colormap;
 // uniform sampler2D normalmap;
 
+// Colormaps of all the stimuli, one stimulus per layer
+uniform sampler2DArray colormap_array;
+// Set to read the colormap from the texture array at layer
+uniform bool texture_arrays;
+uniform int layer;
+
 // -----------------------------------------------------------------
 // LIGHTING VARIABLES
 // -----------------------------------------------------------------
@@ -62,6 +68,8 @@ vec3 get_normal(void) {
 // -----------------------------------------------------------------
 
 vec4 color_mapping(void) {
+    if (texture_arrays)
+        return texture(colormap_array, vec3(fragTexCoord.st, layer));
     return texture(colormap, fragTexCoord.st);
 }
 
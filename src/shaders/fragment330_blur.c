@@ -0,0 +1,36 @@
+#version 330 compatibility
+
+in vec2 fragTexCoord;
+
+// -----------------------------------------------------------------
+// BLUR VARIABLES
+// -----------------------------------------------------------------
+
+// Map being blurred, the heightmap or normalmap of the stimuli or the
+// result of the previous pass
+uniform sampler2D source;
+// Distance between two texels along the axis being blurred, the axis
+// alternating between X and Y on each pass
+uniform vec2 texel_step;
+// Standard deviation of the Gaussian in texels
+uniform float radius;
+
+// -----------------------------------------------------------------
+// MAIN FUNCTION
+// -----------------------------------------------------------------
+
+void main(void) {
+    // Weigh the texels by the 1D Gaussian cut off at 3 radii, as in
+    // blur.gaussian_kernel, wrapping around the edges with GL_REPEAT
+    int extent = int(ceil(3.0 * radius));
+    vec4 total = vec4(0.0, 0.0, 0.0, 0.0);
+    float total_weight = 0.0;
+    for (int i = -extent; i <= extent; ++i) {
+        float weight = exp(-0.5 * pow(float(i) / radius, 2.0));
+        vec2 texcoord = fragTexCoord + float(i) * texel_step;
+        total += weight * texture(source, texcoord);
+        total_weight += weight;
+    }
+
+    gl_FragColor = total / total_weight;
+}
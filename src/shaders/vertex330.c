@@ -7,6 +7,8 @@
 layout (location = 0) in vec2 vertVertex;
 layout (location = 1) in vec2 vertTexCoord;
 layout (location = 2) in vec3 vertNormal;
+// Offset of the position of the stimuli being drawn, one per instance
+layout (location = 3) in vec3 instanceOffset;
 
 uniform mat4 ModelViewMatrix;
 uniform mat4 ProjectionMatrix;
@@ -16,9 +18,38 @@ uniform mat3 NormalMatrix;
 uniform sampler2D heightmap;
 uniform sampler2D normalmap;
 
+// Maps of all the stimuli, one stimulus per layer
+uniform sampler2DArray heightmap_array;
+uniform sampler2DArray normalmap_array;
+// Set to read the maps from the texture arrays at layer
+uniform bool texture_arrays;
+uniform int layer;
+// Set when the heightmap holds the height in r and the normal in g, b
+// and a, as 16-bit values packed by tools.pack_maps
+uniform bool packed_maps;
+
 uniform bool process_stimuli;
 uniform bool per_pixel;
 
+// Size by which to scale the vertices, which are stored on a
+// -1.0 - 1.0 scale when they are compacted into normalized shorts
+uniform vec2 vertex_scale;
+
+// Procedural meshgrid variables
+// Set to derive the meshgrid from gl_VertexID instead of the attributes
+uniform bool procedural_grid;
+// Number of quadrilaterals along the X and Y axes of the meshgrid
+uniform ivec2 grid_cells;
+// Width and height of each quadrilateral as texture coordinates
+uniform vec2 grid_step;
+// Size by which to scale the meshgrid, SCALE_X and SCALE_Y
+uniform vec2 grid_scale;
+
+// Corner of the quadrilateral for each of its 6 GL_TRIANGLES vertices,
+// split along the same diagonal as mesh.triangle_indices
+const ivec2 CORNERS[6] = ivec2[6](ivec2(0, 0), ivec2(1, 0), ivec2(1, 1),
+                                  ivec2(0, 0), ivec2(1, 1), ivec2(0, 1));
+
 // Displacement Mapping variables
 const float SCALE_FACTOR = 15.0;
 
@@ -31,6 +62,18 @@ const float SCALE_FACTOR = 15.0;
 // uniform vec3 light_color[NUM_LIGHTS];
 uniform vec3 light_direction;
 
+// -----------------------------------------------------------------
+// VERTEX VARIABLES
+// -----------------------------------------------------------------
+
+// Attributes of the vertex being processed, either read from the
+// input variables or derived from gl_VertexID
+vec2 vertex;
+vec2 texcoord;
+vec3 normal;
+// Texel of the heightmap for the vertex being processed
+vec4 height_texel;
+
 // -----------------------------------------------------------------
 // OUTPUT VARIABLES
 // -----------------------------------------------------------------
@@ -77,13 +120,45 @@ float convert_desaturation(vec4 pixel) {
 }
 */
 
+// -----------------------------------------------------------------
+// HANDLE MESHGRID
+// -----------------------------------------------------------------
+
+void grid_vertex(void) {
+    // Get the quadrilateral and the corner of it being processed
+    int cell = gl_VertexID / 6;
+    ivec2 corner = CORNERS[gl_VertexID % 6];
+
+    // The quadrilaterals are ordered column by column
+    ivec2 position = ivec2(cell / grid_cells.y, cell % grid_cells.y) + corner;
+
+    texcoord = vec2(position) * grid_step;
+    // Convert the texture coordinates onto a -1.0 - 1.0 scale
+    vertex = (texcoord - 0.5) * 2.0 * grid_scale;
+    normal = vec3(0.0, 0.0, 1.0);
+}
+
+void attribute_vertex(void) {
+    vertex = vertVertex * vertex_scale;
+    texcoord = vertTexCoord;
+    normal = vertNormal;
+}
+
 // -----------------------------------------------------------------
 // HANDLE NORMALS
 // -----------------------------------------------------------------
 
 vec3 get_normal(void) {
+    // The normal is packed along with the height
+    if (packed_maps)
+        return height_texel.gba;
+
     // Get pixel values for TexCoord
-    vec4 pixel = texture(normalmap, vertTexCoord.st);
+    vec4 pixel;
+    if (texture_arrays)
+        pixel = texture(normalmap_array, vec3(texcoord.st, layer));
+    else
+        pixel = texture(normalmap, texcoord.st);
     return vec3(pixel.r, pixel.g, pixel.b);
 }
 
@@ -92,13 +167,21 @@ vec3 get_normal(void) {
 // -----------------------------------------------------------------
 
 vec4 displacement_mapping(void) {
-    vec4 pixel = texture(heightmap, vertTexCoord.st);
+    if (texture_arrays)
+        height_texel = texture(heightmap_array, vec3(texcoord.st, layer));
+    else
+        height_texel = texture(heightmap, texcoord.st);
+
+    vec4 pixel = height_texel;
+    // The packed height is the grey value of r, g and b alike
+    if (packed_maps)
+        pixel = vec4(height_texel.rrr, 1.0);
 
     // Convert RGB to grey value
     float grey_value = convert_luminance(pixel);
 
     // Return displaced position coordinates
-    return vec4(vertNormal * grey_value * SCALE_FACTOR, 0.0) + vec4(vertVertex, 0.0, 1.0);
+    return vec4(normal * grey_value * SCALE_FACTOR, 0.0) + vec4(vertex, 0.0, 1.0);
 }
 
 // -----------------------------------------------------------------
@@ -142,11 +225,17 @@ void directional_lighting(vec3 normal) {
 // -----------------------------------------------------------------
 
 void main(void) {
-    fragTexCoord = vertTexCoord.st;
+    if (procedural_grid)
+        grid_vertex();
+    else
+        attribute_vertex();
+
+    fragTexCoord = texcoord.st;
     vec4 fragVertex = displacement_mapping();
     fragNormal = transpose(inverse(NormalMatrix)) * get_normal();
 
     if (!per_pixel && process_stimuli)
         directional_lighting(fragNormal);
-    gl_Position = ProjectionMatrix * (ModelViewMatrix * fragVertex);
+    gl_Position = ProjectionMatrix * (ModelViewMatrix * fragVertex +
+                                      vec4(instanceOffset, 0.0));
 }
@@ -0,0 +1,56 @@
+#version 330 compatibility
+
+// -----------------------------------------------------------------
+// INPUT VARIABLES
+// ----------------------------------------------------------------
+
+// The vertices are baked on the CPU, already displaced by the height
+// map, and the normals already read from the normal map
+layout (location = 0) in vec3 vertVertex;
+layout (location = 1) in vec2 vertTexCoord;
+layout (location = 2) in vec3 vertNormal;
+// Offset of the position of the stimuli being drawn, one per instance
+layout (location = 3) in vec3 instanceOffset;
+
+uniform mat4 ModelViewMatrix;
+uniform mat4 ProjectionMatrix;
+// Passed already inverted and transposed for transforming the normals
+uniform mat3 NormalMatrix;
+
+uniform bool process_stimuli;
+uniform bool per_pixel;
+
+uniform vec3 light_direction;
+
+// -----------------------------------------------------------------
+// OUTPUT VARIABLES
+// -----------------------------------------------------------------
+
+out vec2 fragTexCoord;
+out vec3 fragNormal;
+out vec3 fragColor;
+
+// -----------------------------------------------------------------
+// HANDLE LIGHTING
+// -----------------------------------------------------------------
+
+void directional_lighting(vec3 normal) {
+    vec3 diffuse = vec3(1.0, 1.0, 1.0);
+
+    float intensity = max(dot(normal, light_direction), 0.0);
+    fragColor = intensity * diffuse;
+}
+
+// -----------------------------------------------------------------
+// MAIN FUNCTION
+// -----------------------------------------------------------------
+
+void main(void) {
+    fragTexCoord = vertTexCoord.st;
+    fragNormal = NormalMatrix * vertNormal;
+
+    if (!per_pixel && process_stimuli)
+        directional_lighting(fragNormal);
+    gl_Position = ProjectionMatrix * (ModelViewMatrix * vec4(vertVertex, 1.0) +
+                                      vec4(instanceOffset, 0.0));
+}
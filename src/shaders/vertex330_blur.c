@@ -0,0 +1,22 @@
+#version 330 compatibility
+
+// -----------------------------------------------------------------
+// OUTPUT VARIABLES
+// -----------------------------------------------------------------
+
+// Texture coordinates of the texel of the map being blurred
+out vec2 fragTexCoord;
+
+// -----------------------------------------------------------------
+// MAIN FUNCTION
+// -----------------------------------------------------------------
+
+void main(void) {
+    // Cover the Frame Buffer Object with a single GL_TRIANGLE_STRIP of
+    // 4 vertices, derived from gl_VertexID so that no attributes are read
+    vec2 corner = vec2(gl_VertexID & 1, gl_VertexID >> 1);
+
+    fragTexCoord = corner;
+    // Convert the texture coordinates onto a -1.0 - 1.0 scale
+    gl_Position = vec4((corner - 0.5) * 2.0, 0.0, 1.0);
+}
@@ -1,18 +1,16 @@
-from PIL.Image import open as img_open
-
-from pyglet.image import load
-from pyglet.resource import texture
+from collections import OrderedDict
 
 from random import randint, shuffle
 
 from settings import (
                       # FILENAMES,
                       COLORMAPS, HEIGHTMAPS, NORMALMAPS,
-                      # GAUSSIAN_BLURS,
+                      GAUSSIAN_BLURS,
                       STIMULI_REPETITION, PRACTICE_STIMULI,
-                      # PREPROCESSED_IMAGES,
-                      HEIGHT_RATIO, POSSIBLE_SLANTS,
-                      STIMULI_ONLY, WIDTH, HEIGHT
+                      PREPROCESSED_IMAGES,
+                      HEIGHT_RATIO, POSSIBLE_SLANTS, TRIAL_BLURS, MIPMAPS,
+                      STIMULI_ONLY, STIMULI_WINDOW,
+                      VORONOI_SOURCE, VORONOI_STIMULI
 )
 
 # The Gaussian Blur provided by PIL only allows for a radius of 2
@@ -20,6 +18,11 @@ from settings import (
 # from tools import GaussianBlur2
 # from tools import pixel_access
 # from tools import save_to_file
+from blur import blur, load_blur_levels, load_blurred
+from mipmaps import load_mipmapped
+from normalmaps import load_normalmap
+from tools import load_all_pixels, load_pixels, pack_maps, set_source
+from voronoi import load_voronoi, load_voronoi_map, load_voronoi_mipmapped
 
 
 class Stimuli(object):
@@ -27,32 +30,29 @@ class Stimuli(object):
     Load the voronoi image stimuli and heightmap in order to create
     the stimuli
 
-    NOTE: All colormaps are preloaded but the heightmaps are loaded
-    as required
+    NOTE: The maps are loaded as they are required, by MapLoader
     """
 
 # ------------------------------------------------------------------
 # HANDLE INITIALIZATION
 # ------------------------------------------------------------------
 
-    # def __init__(self, *args, **kwargs):
-        #  """
-        # If the images have not been processed and made into heightmaps,
-        # Stimuli will take care of it during the initialization
-        # """
+    def __init__(self, *args, **kwargs):
+        """
+        If the images have not been processed and made into heightmaps,
+        Stimuli will take care of it during the initialization
+        """
         # If the images have not had blurred renderings made for them,
         # we can make it at this stage in the pipeline
-        # if not PREPROCESSED_IMAGES:
+        if not PREPROCESSED_IMAGES and not VORONOI_SOURCE:
             # Create blurred imaged with varying radii
-            # self.__blur_images()
-            # Handle any situation if it arises in future that the
-            # initialization module is called again
+            self.__blur_images()
 
     def setup(self, practice=False):
         """
         Load up all the unique stimuli into memory
 
-        NOTE: This does not include heightmaps
+        NOTE: The images themselves are only loaded when first used
         """
         # MULTIPLE STIMULI IMAGES
         # Load up all the images that will be used as colormaps
@@ -72,9 +72,37 @@ class Stimuli(object):
         self.heightmap = HEIGHTMAPS
         self.normalmap = NORMALMAPS
 
-        self.colormap = self.__load_image(self.colormap)
-        self.heightmap = self.__load_image(self.heightmap)
-        self.normalmap = self.__load_image(self.normalmap)
+        if VORONOI_SOURCE:
+            self.__setup_voronoi()
+        else:
+            # The colormaps are loaded along with their mip chains
+            if MIPMAPS:
+                self.colormap = MapLoader(self.colormap, load_mipmapped)
+            else:
+                self.colormap = MapLoader(self.colormap)
+            self.heightmap = MapLoader(self.heightmap)
+            # The normalmaps missing are built from the heightmaps
+            self.normalmap = MapLoader(zip(HEIGHTMAPS, self.normalmap),
+                                       load_normalmap)
+        # The heightmap and normalmap of each stimuli packed together,
+        # from those loaded above
+        self.packedmap = MapLoader(range(self.num_maps), self.__pack_maps)
+        # The heightmaps blurred with each of the radii, blurred when
+        # first used unless already in the asset cache, and the normalmaps
+        # blurred along with them so that the lighting follows them
+        self.blurmap, self.blurnormal, self.blurpacked = {}, {}, {}
+        for radius in set(GAUSSIAN_BLURS + TRIAL_BLURS) - set([0]):
+            blurs = [(i, radius) for i in range(self.num_maps)]
+            # The generated heightmaps have no image to be cached under
+            if VORONOI_SOURCE:
+                self.blurmap[radius] = MapLoader(blurs,
+                                                 self.__blur_heightmap)
+            else:
+                self.blurmap[radius] = MapLoader(
+                    [(filename, radius) for filename in HEIGHTMAPS],
+                    load_blurred)
+            self.blurnormal[radius] = MapLoader(blurs, self.__blur_normalmap)
+            self.blurpacked[radius] = MapLoader(blurs, self.__pack_blurred)
 
         # print self.colormap, self.heightmap, self.normalmap
 
@@ -100,57 +128,33 @@ class Stimuli(object):
         # Set the first run state to be used
         self.run_state = self.states.pop(0)
 
-    def __blur_images(self):
+    def __setup_voronoi(self):
         """
-        Blur all the provided images and save the blurred image to file
+        Load the maps of the Voronoi stimuli, each of the seeds of which
+        is the index of the stimuli, in place of the images
         """
-        # Iterating through the images provided in settings
-        # for filename in FILENAMES:
-            # Open the image
-            # img = img_open(filename)
-            # Select radius for Gaussian Blur
-            # for radius in GAUSSIAN_BLURS:
-                # gblur = GaussianBlur2(radius)
-                # Apply the blur
-                # temp_img = img.filter(gblur)
-                # Save to file
-                # temp_img.save(self.__blur_imagename(filename, radius))
+        self.num_maps = VORONOI_STIMULI
+        seeds = range(VORONOI_STIMULI)
+        # Each map is loaded from the asset cache on its own, with no
+        # state shared between the loaders, as the Prefetcher threads
+        # load them too
+        if MIPMAPS:
+            self.colormap = MapLoader(seeds, load_voronoi_mipmapped)
+        else:
+            self.colormap = MapLoader([(i, 0) for i in seeds],
+                                      load_voronoi_map)
+        self.heightmap = MapLoader([(i, 1) for i in seeds], load_voronoi_map)
+        self.normalmap = MapLoader([(i, 2) for i in seeds], load_voronoi_map)
 
-    def __blur_imagename(self, filename, radius):
+    def __blur_images(self):
         """
-        Return the filename for the Gaussian Blurred image
+        Blur all the provided heightmaps with each of the GAUSSIAN_BLURS
+        and save the blurred heightmaps to the asset cache
         """
-        return '%s_gblur%d.jpg' % (filename[:-4], radius)
-
-    def __load_image(self, imgs):
-        maps = []
-
-        # Iterating through the filenames
-        for img in imgs:
-            # Load the image and store it in memory
-            maps.append(load(img))
-
-        return maps
-
-    def __load_pixel(self, imgs):
-        maps = []
-        fmat = 'RGB'
-        pitch = WIDTH * len(fmat)
-
-        for img in imgs:
-            img_pil = img_open(img)
-            img_pyglet = load(img)
-            pixels = img_pil.load()
-
-            all_pixels = []
-            for x in range(WIDTH):
-                for y in range(HEIGHT):
-                    all_pixels.append(pixels[x, y])
-
-            img_pyglet.set_data(fmat, pitch, all_pixels)
-            maps.append(img_pyglet)
-
-        return maps
+        # Iterating through the images provided in settings, blurring
+        # each with all the radii in parallel
+        for filename in HEIGHTMAPS:
+            load_blur_levels(filename)
 
 # ------------------------------------------------------------------
 # HANDLE STIMULI STATES
@@ -191,10 +195,8 @@ class Stimuli(object):
         # num = randint(0, len(GAUSSIAN_BLURS) - 1)
         # Select the radius of the blur requested
         # num = GAUSSIAN_BLURS[num]
-        # Get the filename of the blurred image
-        # filename = self.__blur_imagename(FILENAMES[self.current], num)
-        # Load the heightmap image to be used next
-        # self.heightmap = load(filename)
+        # Load the blurred heightmap image to be used next
+        # heightmap = self.blurmap[num][self.current]
 
         # Return true and continue with the practice block
         return True
@@ -211,8 +213,10 @@ class Stimuli(object):
         for i in range(0, self.num_maps):
                 for j in range(0, len(HEIGHT_RATIO)):
                     for k in range(0, len(POSSIBLE_SLANTS)):
-                        temp_order.append((i, HEIGHT_RATIO[j],
-                                          POSSIBLE_SLANTS[k]))
+                        for m in range(0, len(TRIAL_BLURS)):
+                            temp_order.append((i, HEIGHT_RATIO[j],
+                                              POSSIBLE_SLANTS[k],
+                                              TRIAL_BLURS[m]))
 
         for i in range(0, STIMULI_REPETITION):
             self.order += temp_order
@@ -236,18 +240,90 @@ class Stimuli(object):
         # Set the next action state
         self.run_state = self.states.pop(0)
 
+    def load_all(self, packed=False):
+        """
+        Load the maps of all the stimuli at once, decoding them in
+        parallel, returning the colormaps, heightmaps and normalmaps
+
+        If packed is set, the heightmaps are returned packed with the
+        normalmaps, in place of the heightmaps, and no normalmaps
+        """
+        if VORONOI_SOURCE:
+            # The generated stimuli are loaded from the asset cache
+            maps = map(list, zip(*map(load_voronoi,
+                                      range(VORONOI_STIMULI))))
+        else:
+            images = load_all_pixels(COLORMAPS + HEIGHTMAPS)
+            maps = [images[:len(COLORMAPS)], images[len(COLORMAPS):]]
+            maps.append(load_all_pixels(zip(HEIGHTMAPS, NORMALMAPS),
+                                        load=load_normalmap))
+        if packed:
+            maps[1] = map(pack_maps, maps[1], maps[2])
+            maps[2] = None
+        return maps
+
+    def __pack_maps(self, index):
+        """
+        Pack the heightmap and normalmap of the stimuli at index
+        """
+        return pack_maps(self.heightmap[index], self.normalmap[index])
+
+    def blurred_maps(self, index, radius, packed=False):
+        """
+        Get the heightmap and normalmap of the stimuli at index blurred
+        by radius, or the two packed together and None, if packed is set
+        """
+        if packed:
+            return [self.blurpacked[radius][index], None]
+        return [self.blurmap[radius][index], self.blurnormal[radius][index]]
+
+    def __blur_heightmap(self, source):
+        """
+        Blur the heightmap of the stimuli at index by radius
+        """
+        index, radius = source
+        return blur(self.heightmap[index], radius)
+
+    def __blur_normalmap(self, source):
+        """
+        Blur the normalmap of the stimuli at index by radius, as the
+        heightmap is blurred
+        """
+        index, radius = source
+        return blur(self.normalmap[index], radius)
+
+    def __pack_blurred(self, source):
+        """
+        Pack the blurred heightmap and normalmap of the stimuli at index
+        """
+        index, radius = source
+        return pack_maps(self.blurmap[radius][index],
+                         self.blurnormal[radius][index])
+
+    def upcoming(self, count):
+        """
+        Get the stimuli to be presented after the current one, up to
+        count of them
+        """
+        if not hasattr(self, 'order') or not self.order:
+            return []
+        return self.order[:count]
+
     def __random_stimuli(self):
         stimuli = randint(0, self.num_maps - 1)
         j = randint(0, len(HEIGHT_RATIO) - 1)
         k = randint(0, len(POSSIBLE_SLANTS) - 1)
-        return (stimuli, HEIGHT_RATIO[j], POSSIBLE_SLANTS[k])
+        m = randint(0, len(TRIAL_BLURS) - 1)
+        # The stimuli displayed alone with STIMULI_ONLY are never blurred
+        radius = 0 if STIMULI_ONLY else TRIAL_BLURS[m]
+        return (stimuli, HEIGHT_RATIO[j], POSSIBLE_SLANTS[k], radius)
 
     def __print_order(self):
         print 'There are %d stimuli to be presented and the order will be as follows:'\
               % len(self.order)
-        print 'IMAGE\tHEIGHT_RATIO\tSLANT'
-        for img, height_ratio, slant in self.order:
-            print '%s\t%s\t\t%s' % (img, height_ratio, slant)
+        print 'IMAGE\tHEIGHT_RATIO\tSLANT\tBLUR'
+        for img, height_ratio, slant, blur in self.order:
+            print '%s\t%s\t\t%s\t%s' % (img, height_ratio, slant, blur)
 
 # ------------------------------------------------------------------
 # DEPRECATED MODULES
@@ -310,6 +386,71 @@ class Stimuli(object):
         # return tile
 
 
+class MapLoader(object):
+    """
+    Load the images of one type of map as they are indexed, instead of
+    all of them up front, keeping only the window most recently used of
+    them in memory
+
+    The images are loaded as arrays of their pixels by load, from their
+    source, by default their filename passed to tools.load_pixels
+    Each image is set the key of its source, so that its texture is found
+    in the texture cache even once it is loaded again
+    """
+
+    def __init__(self, sources, load=load_pixels, window=STIMULI_WINDOW,
+                 *args, **kwargs):
+        """
+        Set the sources of the images, none of which are loaded yet
+        """
+        self.sources = sources
+        self.load = load
+        self.window = window
+        # Images kept in memory, keyed by their index, from the least
+        # to the most recently used
+        self.images = OrderedDict()
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __getitem__(self, index):
+        """
+        Get the image at index, loading it if it is not in memory
+        """
+        if index in self.images:
+            # Move the image to the most recently used
+            image = self.images.pop(index)
+        else:
+            # Raises IndexError past the last image, ending iteration
+            image = self.load(self.sources[index])
+            set_source(image, self.key(index))
+        self.images[index] = image
+
+        # Drop the least recently used images beyond the window
+        while len(self.images) > self.window:
+            self.images.popitem(last=False)
+        return image
+
+    def key(self, index):
+        """
+        Get the key of the source of the image at index, along with how it
+        is loaded, as the same source is loaded into different maps
+        """
+        return (self.load.__name__, self.sources[index])
+
+    def put(self, index, image):
+        """
+        Keep the image at index, already loaded elsewhere, unless it is
+        already in memory
+        """
+        if image is None or index in self.images:
+            return
+        set_source(image, self.key(index))
+        self.images[index] = image
+        while len(self.images) > self.window:
+            self.images.popitem(last=False)
+
+
 if __name__ == '__main__':
     # Run the experiment even without running it directly from main.py
     from main import run_experiment
@@ -0,0 +1,377 @@
+from collections import OrderedDict
+
+from ctypes import memmove
+
+from numpy import ascontiguousarray
+
+from OpenGL.GL import (
+                       glBindBuffer, glBufferData, glDeleteBuffers,
+                       glCompressedTexImage2D,
+                       glMapBufferRange, glUnmapBuffer,
+                       glClientWaitSync, glDeleteSync, glFenceSync, glFlush,
+                       glBindTexture, glPixelStorei, glTexImage2D,
+                       glTexImage3D, glTexSubImage3D, glTexParameterf,
+                       glTexParameteri,
+                       GL_LINEAR, GL_LUMINANCE, GL_REPEAT, GL_RGB, GL_RGB8,
+                       GL_RGBA, GL_RGBA16,
+                       GL_TEXTURE_2D, GL_TEXTURE_2D_ARRAY,
+                       GL_TEXTURE_MAG_FILTER, GL_TEXTURE_MIN_FILTER,
+                       GL_TEXTURE_MAX_LEVEL, GL_LINEAR_MIPMAP_LINEAR,
+                       GL_TEXTURE_WRAP_S, GL_TEXTURE_WRAP_T,
+                       GL_UNPACK_ALIGNMENT, GL_UNSIGNED_BYTE,
+                       GL_UNSIGNED_SHORT,
+                       GL_PIXEL_UNPACK_BUFFER, GL_STREAM_DRAW,
+                       GL_MAP_WRITE_BIT, GL_MAP_INVALIDATE_BUFFER_BIT,
+                       GL_SYNC_GPU_COMMANDS_COMPLETE,
+                       GL_SYNC_FLUSH_COMMANDS_BIT,
+                       GL_TIMEOUT_EXPIRED, GL_TIMEOUT_IGNORED
+)
+from OpenGL.GL.EXT.texture_compression_s3tc import (
+                       GL_COMPRESSED_RGB_S3TC_DXT1_EXT
+)
+
+from pyglet.gl import glDeleteTextures, glGenBuffers, glGenTextures, GLuint
+
+from buffers import pointer
+from settings import TEXTURE_BUDGET
+from tools import source_key
+
+
+# OpenGL format of the pixels of the images with each number of
+# channels, as loaded by tools.load_pixels. The textures are stored in
+# GL_RGB whatever the format, so they are sampled the same way
+PIXEL_FORMATS = {1: GL_LUMINANCE, 3: GL_RGB, 4: GL_RGBA}
+# OpenGL type of the pixels of the images of each numpy type, and the
+# format the textures are stored in. 16-bit images, such as the maps
+# packed by tools.pack_maps, keep their precision
+PIXEL_TYPES = {
+               'uint8': (GL_UNSIGNED_BYTE, GL_RGB),
+               'uint16': (GL_UNSIGNED_SHORT, GL_RGBA16)
+}
+
+
+class TextureCache(object):
+    """
+    Keep the images uploaded as textures on the GPU, so that each image
+    is only uploaded once and switching between them only binds them
+
+    The textures are kept in the order they were last used, and the
+    least recently used are deleted to stay within the budget
+
+    Images can also be prefetched ahead of their use: their pixels are
+    written into a Pixel Buffer Object and copied into the texture by
+    the GPU without blocking, with a fence marking when the copy is done
+    """
+
+    # Number of the most recently used textures that are never deleted
+    # to stay within the budget, the colormap, heightmap and normalmap of
+    # a stimulus
+    keep = 3
+
+    def __init__(self, budget=TEXTURE_BUDGET, *args, **kwargs):
+        """
+        Set the budget of GPU memory in megabytes
+        """
+        self.budget = budget * 1024 * 1024
+        self.used = 0
+        # Entries of the resident textures, keyed by the source of the
+        # image, from the least to the most recently used
+        # NOTE: The images themselves are not kept, so that they are
+        #       freed once they are no longer used
+        self.entries = OrderedDict()
+        # Keys of the textures got since the last release, which are
+        # bound and never deleted
+        self.in_use = set()
+        # Pixel Buffer Objects no longer read by any pending copy
+        self.pixel_buffers = []
+
+    def get(self, image):
+        """
+        Get the texture holding image, uploading image if it is not
+        already resident, which is in use until the next release
+        """
+        key = source_key(image)
+        self.in_use.add(key)
+        if key in self.entries:
+            # Move the entry to the most recently used
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+            # Only wait on a copy that has not been finished yet, which
+            # the prefetch should have left enough time for
+            self.__finish(entry, GL_TIMEOUT_IGNORED)
+            return entry['texture']
+
+        return self.__add(image, upload(image))['texture']
+
+    def release(self):
+        """
+        Let the textures got so far be deleted to stay within the budget,
+        once they are no longer bound
+        """
+        self.in_use.clear()
+
+    def prefetch(self, image):
+        """
+        Start uploading image if it is not already resident, without
+        waiting for the upload to finish
+        """
+        if source_key(image) in self.entries:
+            return
+
+        # Reuse a Pixel Buffer Object whose copy has been finished
+        self.__poll()
+        if self.pixel_buffers:
+            pixel_buffer = self.pixel_buffers.pop()
+        else:
+            pixel_buffer = GLuint(0)
+            glGenBuffers(1, pixel_buffer)
+            pixel_buffer = pixel_buffer.value
+
+        entry = self.__add(image, upload_async(image, pixel_buffer))
+        entry['pixel_buffer'] = pixel_buffer
+        # Mark the end of the copy, then make sure the copy is sent to
+        # the GPU without waiting for the next buffer swap
+        entry['fence'] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        glFlush()
+
+    def __add(self, image, texture):
+        """
+        Add the entry for the texture holding image, as the most
+        recently used
+        """
+        size = texture_size(image)
+        self.__evict(size)
+
+        entry = {'texture': texture, 'size': size, 'pixel_buffer': None,
+                 'fence': None}
+        self.entries[source_key(image)] = entry
+        self.used += size
+        return entry
+
+    def __finish(self, entry, timeout=0):
+        """
+        Wait up to timeout nanoseconds for the copy into the texture of
+        entry to finish, returning whether it has finished
+        """
+        if entry['fence'] is None:
+            return True
+        if glClientWaitSync(entry['fence'], GL_SYNC_FLUSH_COMMANDS_BIT,
+                            timeout) == GL_TIMEOUT_EXPIRED:
+            return False
+
+        glDeleteSync(entry['fence'])
+        entry['fence'] = None
+        # The Pixel Buffer Object is free to be written into again
+        self.pixel_buffers.append(entry['pixel_buffer'])
+        entry['pixel_buffer'] = None
+        return True
+
+    def __poll(self):
+        """
+        Free the Pixel Buffer Objects of all the copies that have been
+        finished, without waiting
+        """
+        for entry in self.entries.values():
+            self.__finish(entry)
+
+    def __evict(self, size):
+        """
+        Delete the least recently used textures, until size more bytes
+        fit within the budget, other than those in use and the keep most
+        recently used
+        """
+        for key in self.entries.keys()[:-self.keep]:
+            if self.used + size <= self.budget:
+                return
+            if key in self.in_use:
+                continue
+            entry = self.entries.pop(key)
+            self.__finish(entry, GL_TIMEOUT_IGNORED)
+            glDeleteTextures(1, GLuint(entry['texture']))
+            self.used -= entry['size']
+
+    def clear(self):
+        """
+        Delete all the resident textures
+        """
+        for entry in self.entries.values():
+            self.__finish(entry, GL_TIMEOUT_IGNORED)
+            glDeleteTextures(1, GLuint(entry['texture']))
+        for pixel_buffer in self.pixel_buffers:
+            glDeleteBuffers(1, GLuint(pixel_buffer))
+        self.entries.clear()
+        self.in_use.clear()
+        self.pixel_buffers = []
+        self.used = 0
+
+
+# ------------------------------------------------------------------
+# HELPER FUNCTIONS
+# ------------------------------------------------------------------
+
+def upload(image):
+    """
+    Upload the image, an array of pixels as loaded by tools.load_pixels
+    or a mipmaps.MipChain, into a new texture on the GPU, returning the
+    texture, which is left bound to GL_TEXTURE_2D
+    """
+    levels = mip_levels(image)
+    texture = generate(GL_TEXTURE_2D, len(levels))
+    for level, pixels in enumerate(levels):
+        pixels = ascontiguousarray(pixels)
+        # Assign 2D texture, straight from the buffer of the array
+        image_level(image, level, pixels, pixels)
+    return texture
+
+
+def upload_async(image, pixel_buffer):
+    """
+    Upload the image into a new texture on the GPU through pixel_buffer,
+    returning the texture before the GPU has copied the pixels into it
+    """
+    levels = [ascontiguousarray(pixels) for pixels in mip_levels(image)]
+    # Offset of each level in the Pixel Buffer Object, aligned so that
+    # any alignment of its rows is kept
+    offsets = []
+    size = 0
+    for pixels in levels:
+        offsets.append(size)
+        size += -(-pixels.nbytes // 8) * 8
+
+    glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pixel_buffer)
+    # Orphan the previous storage, so that writing into it never waits
+    # on a copy still reading from it
+    glBufferData(GL_PIXEL_UNPACK_BUFFER, size, None, GL_STREAM_DRAW)
+    address = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, size,
+                               GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT)
+    for pixels, offset in zip(levels, offsets):
+        memmove(address + offset, pixels.ctypes.data, pixels.nbytes)
+    glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+
+    texture = generate(GL_TEXTURE_2D, len(levels))
+    # With a Pixel Buffer Object bound, the pixels are read from it,
+    # starting at the offset of each level, and the calls return
+    # straight away
+    for level, (pixels, offset) in enumerate(zip(levels, offsets)):
+        image_level(image, level, pixels, pointer(offset))
+    glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+    return texture
+
+
+def image_level(image, level, pixels, data):
+    """
+    Specify the level of the texture bound to GL_TEXTURE_2D for the
+    image, from data, the pixels of the level or their offset into the
+    bound Pixel Buffer Object
+    """
+    # Each level is half the width and height of the one before
+    height = max(1, image.shape[0] >> level)
+    width = max(1, image.shape[1] >> level)
+    if getattr(image, 'compressed', False):
+        glCompressedTexImage2D(GL_TEXTURE_2D, level,
+                               GL_COMPRESSED_RGB_S3TC_DXT1_EXT, width, height,
+                               0, pixels.nbytes, data)
+        return
+
+    var_type, internal = PIXEL_TYPES[image.dtype.name]
+    glPixelStorei(GL_UNPACK_ALIGNMENT, unpack_alignment(pixels))
+    glTexImage2D(GL_TEXTURE_2D, level, internal, width, height, 0,
+                 pixel_format(pixels), var_type, data)
+
+
+def upload_array(images):
+    """
+    Upload the images into a new texture array on the GPU, one image
+    per layer, returning the texture array, which is left bound to
+    GL_TEXTURE_2D_ARRAY
+
+    NOTE: All the images must be of the same width and height
+    """
+    height, width = images[0].shape[:2]
+    var_type, internal = PIXEL_TYPES[images[0].dtype.name]
+    # Only sized formats can be used for texture arrays
+    if internal == GL_RGB:
+        internal = GL_RGB8
+
+    texture = generate(GL_TEXTURE_2D_ARRAY)
+    # Allocate all the layers, then fill in each of them
+    glTexImage3D(GL_TEXTURE_2D_ARRAY, 0, internal, width, height, len(images),
+                 0, GL_RGB, var_type, None)
+    for layer, image in enumerate(images):
+        image = ascontiguousarray(image)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, unpack_alignment(image))
+        glTexSubImage3D(GL_TEXTURE_2D_ARRAY, 0, 0, 0, layer, width, height, 1,
+                        pixel_format(image), var_type, image)
+    return texture
+
+
+def generate(target, levels=1):
+    """
+    Generate a new texture bound to target, with the settings used for
+    all the textures, and the number of levels of its mip chain
+    """
+    texture = GLuint(0)
+    glGenTextures(1, texture)
+    texture = texture.value
+
+    glBindTexture(target, texture)
+    # Settings for use of the texture
+    glTexParameterf(target, GL_TEXTURE_WRAP_S, GL_REPEAT)
+    glTexParameterf(target, GL_TEXTURE_WRAP_T, GL_REPEAT)
+
+    glTexParameterf(target, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    # Blend between the levels of the mip chain, if there is one
+    if levels > 1:
+        glTexParameterf(target, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+    else:
+        glTexParameterf(target, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(target, GL_TEXTURE_MAX_LEVEL, levels - 1)
+    return texture
+
+
+def mip_levels(image):
+    """
+    Get the levels of the mip chain of the image, only the image itself
+    if it is an array of pixels
+    """
+    return getattr(image, 'levels', [image])
+
+
+def texture_size(image):
+    """
+    Get the bytes of GPU memory taken by the texture of the image
+    """
+    if getattr(image, 'compressed', False):
+        return image.nbytes
+    # Textures in GL_RGB are stored with 4 bytes per texel by most
+    # drivers, and those in GL_RGBA16 with 8
+    size = image.shape[0] * image.shape[1] * 4 * image.itemsize
+    # A full mip chain takes up another third
+    if len(mip_levels(image)) > 1:
+        size += size // 3
+    return size
+
+
+def pixel_format(image):
+    """
+    Get the OpenGL format of the pixels of the image, by its number of
+    channels
+    """
+    channels = image.shape[2] if image.ndim > 2 else 1
+    return PIXEL_FORMATS[channels]
+
+
+def unpack_alignment(image):
+    """
+    Get the largest alignment OpenGL accepts that each row of the image
+    starts at, so that rows of any width are read correctly
+    """
+    for alignment in (8, 4, 2, 1):
+        if not image.strides[0] % alignment:
+            return alignment
+
+
+if __name__ == '__main__':
+    # Run the experiment even without running it directly from main.py
+    from main import run_experiment
+    run_experiment()
@@ -1,9 +1,16 @@
-from PIL.Image import fromarray
+from PIL.Image import FLIP_TOP_BOTTOM, fromarray, open as img_open
 from PIL.ImageFilter import Filter
 
+from itertools import count
+
 from math import pi
 
-from numpy import ndarray, uint8
+from multiprocessing.pool import ThreadPool
+
+from numpy import (
+                   absolute, asarray, clip, dstack, flipud, float32, float64,
+                   floor, iinfo, ndarray, rint, sign, uint8, uint16
+)
 
 from OpenGL.GL import (
                        glGetString,
@@ -11,7 +18,17 @@ from OpenGL.GL import (
                        GL_RENDERER,
 )
 
-from settings import WIDTH, HEIGHT
+from weakref import ref
+
+from bundle import open_bundle
+from settings import DECODE_WORKERS, WIDTH, HEIGHT
+
+
+# Key of the source of each image, by the identity of the image, along
+# with a weak reference to the image so that the key is dropped with it
+SOURCE_KEYS = {}
+# Numbers of the keys of the images with no source set
+UNNAMED_IMAGES = count()
 
 
 class GaussianBlur2(Filter):
@@ -130,6 +147,46 @@ def convert_scale(*args):
     return result
 
 
+def get_coords_array(X, Y, scaleX, scaleY):
+    """
+    Array version of get_coords, calculating the normalized texture
+    coordinates and the scaled vertices for all the points in X and Y
+    in a single pass
+    """
+    x = asarray(X, dtype=float64) / float(WIDTH)
+    y = asarray(Y, dtype=float64) / float(HEIGHT)
+
+    # Use convert_scale_array
+    vertX, vertY = convert_scale_array(x, y)
+    return [x, y, vertX * scaleX, vertY * scaleY]
+
+
+def convert_scale_array(*args):
+    """
+    Array version of convert_scale, converting every array passed on a
+    0.0 - 1.0 scale to a -1.0 - 1.0 scale
+
+    >>> convert_scale_array([0.0, 0.25, 1.0])[0].tolist()
+    [-1.0, -0.5, 1.0]
+    """
+    # To store the results
+    result = []
+    # Run through the arguments
+    for arg in args:
+        arg = asarray(arg, dtype=float64)
+        # Print error if any element does not conform to the correct
+        # scale, then clip it into the range
+        if (arg < 0.0).any() or (arg > 1.0).any():
+            print 'ERROR: Arguments passed to tools.convert_scale_array ' +\
+                  'must be on a scale of 0.0 - 1.0. Clipping the values'
+            arg = clip(arg, 0.0, 1.0)
+        # Convert numbers to 4 decimal places, rounding halves away
+        # from zero as the built-in round does
+        arg = (arg - 0.5) * 2
+        result.append(sign(arg) * floor(absolute(arg) * 1e4 + 0.5) / 1e4)
+    return result
+
+
 def pixel_access(image):
     """
     Get access to the pixel data to be able to render the OpenGL
@@ -146,6 +203,148 @@ def pixel_access(image):
     return rawimage.get_data(fmat, pitch)
 
 
+def load_array(filename, mode='RGB'):
+    """
+    Load the image as a numpy array of values on a 0.0 - 1.0 scale
+
+    The rows are flipped so that the first row is the bottom of the
+    image, as it is for the texture coordinates in OpenGL
+    """
+    img = img_open(filename).convert(mode)
+    return flipud(asarray(img, dtype=float32) / 255.0)
+
+
+# Bundle of the decoded images, opened on first use
+bundle = []
+
+
+def load_pixels(filename):
+    """
+    Load the image as a numpy array of its pixels in their own channel
+    layout, to be uploaded as a texture without being converted: a
+    single channel for greyscale images and three for RGB images
+
+    The image is mapped from the bundle if it has been packed into it,
+    otherwise it is decoded
+    """
+    if not bundle:
+        bundle.append(open_bundle())
+    if bundle[0] is not None:
+        pixels = bundle[0].get(filename)
+        if pixels is not None:
+            return pixels
+    return decode_pixels(filename)
+
+
+def decode_pixels(filename):
+    """
+    Decode the image as load_pixels does, without the bundle
+
+    The rows are flipped so that the first row is the bottom of the
+    image, as it is for the texture coordinates in OpenGL
+    """
+    img = img_open(filename)
+    # Keep the precision of 16-bit greyscale images, such as heightmaps
+    if img.mode in ('I', 'I;16'):
+        img = img.transpose(FLIP_TOP_BOTTOM)
+        return clip(asarray(img), 0, 65535).astype(uint16)
+    if img.mode not in ('L', 'RGB', 'RGBA'):
+        img = img.convert('RGB')
+    # Flip the rows while still decoded by PIL, so that the array is
+    # contiguous and its buffer can be passed to OpenGL as it is
+    return asarray(img.transpose(FLIP_TOP_BOTTOM))
+
+
+def load_all_pixels(filenames, workers=DECODE_WORKERS, load=load_pixels):
+    """
+    Load all the images with load, by default load_pixels, in the same
+    order, decoding them in parallel on a pool of threads, as PIL
+    releases the GIL while it decodes
+    """
+    pool = ThreadPool(max(1, min(workers, len(filenames))))
+    try:
+        return pool.map(load, filenames)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def pack_maps(heightmap, normalmap):
+    """
+    Pack the heightmap and the normalmap of a stimulus, arrays as loaded
+    by load_pixels, into a single array of 16-bit RGBA pixels: the
+    height in red and the normal in green, blue and alpha
+
+    The height is stored as the grey value for which convert_luminance
+    in the vertex shader gives the same displacement, when passed as
+    each of r, g and b, as the heightmap does
+
+    >>> from numpy import array
+    >>> packed = pack_maps(array([[0, 255]], dtype=uint8),
+    ...                    array([[[255, 0, 128], [0, 0, 0]]], dtype=uint8))
+    >>> packed.dtype.name, packed[0, 1, 0], packed[0, 0, 1:].tolist()
+    ('uint16', 65535, [65535, 0, 32896])
+    """
+    height = unit_scale(heightmap)
+    # The grey value of greyscale heightmaps is already their height
+    if height.ndim > 2:
+        height = (shader_luminance(height) - 0.7152) / 1.2848
+    normal = unit_scale(normalmap)
+    if normal.ndim < 3:
+        normal = dstack([normal] * 3)
+
+    packed = dstack([height, normal[..., :3]])
+    return rint(clip(packed, 0.0, 1.0) * 65535).astype(uint16)
+
+
+def unit_scale(pixels):
+    """
+    Convert the pixels of any integer type onto a 0.0 - 1.0 scale
+
+    >>> unit_scale(asarray([0, 255], dtype=uint8)).tolist()
+    [0.0, 1.0]
+    """
+    return asarray(pixels, dtype=float64) / iinfo(pixels.dtype).max
+
+
+def set_source(image, key):
+    """
+    Set the key of the source of image, such as its filename or seed
+    along with the map loaded from it, under which TextureCache keeps its
+    texture, so that the image loaded again is not uploaded again
+    """
+    identity = id(image)
+
+    def forget(reference):
+        # Only drop the key if it has not been set for another image
+        if SOURCE_KEYS.get(identity, (None,))[0] is reference:
+            del SOURCE_KEYS[identity]
+
+    SOURCE_KEYS[identity] = (ref(image, forget), key)
+
+
+def source_key(image):
+    """
+    Get the key of the source of image, or a key of its own if it has no
+    source set
+    """
+    entry = SOURCE_KEYS.get(id(image))
+    if entry is None or entry[0]() is not image:
+        set_source(image, ('image', next(UNNAMED_IMAGES)))
+        entry = SOURCE_KEYS[id(image)]
+    return entry[1]
+
+
+def shader_luminance(pixels):
+    """
+    Convert RGB pixels on a 0.0 - 1.0 scale to the grey value used for
+    displacement mapping, exactly as convert_luminance does in the
+    vertex shader
+    """
+    return (0.2126 * pixels[..., 0]) + (0.7152 + pixels[..., 1]) + \
+        (0.0722 * pixels[..., 2])
+
+
 def get_time(start, end):
     return round(end - start, 4)
 
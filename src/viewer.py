@@ -13,11 +13,12 @@ from time import time
 from winsound import Beep
 
 from inclinometer import Inclinometer
+from prefetch import Prefetcher
 # from projection import Projection
 from render import Render
 from settings import (
                       BREAK_DURATION, BREAK_INTERVAL, ENABLE_SHADER,
-                      FIX_DUR,
+                      FIX_DUR, PREFETCH_DEPTH,
                       STIMULI_ONLY,
                       # SCALE_X, SCALE_Y
 )
@@ -120,9 +121,19 @@ class Viewer(Window):
             self.stimulus.setup(self.practice)
         else:
             self.stimulus.setup()
+        # Upload the maps of all the stimuli, if texture arrays are used
+        if self.render.texture_arrays:
+            maps = self.stimulus.load_all(self.render.packed_maps)
+            self.render.create_texture_arrays(*maps)
         # Ready the next stimuli block
         self.stimulus.run_state()
 
+        # Decode the maps of the upcoming stimuli in the background, if
+        # they are uploaded ahead of their display
+        self.prefetcher = None
+        if self.render.async_upload:
+            self.prefetcher = Prefetcher()
+
         # Keep a list of possible stimuli rotations about the Z-axis
         # self.z_rotation = [0]
 
@@ -213,6 +224,10 @@ class Viewer(Window):
         # and assign current_img as the texture
         self.__ready_texture(False, self.render.bind_message)
 
+        # Start decoding the maps of the first stimuli of the block
+        if not self.ended:
+            self.__prefetch_stimuli()
+
     def __ready_block(self):
         """
         Extend the list of states so as to include the state change
@@ -252,6 +267,12 @@ class Viewer(Window):
         # and assign current_img as the texture
         self.__ready_texture(False, self.render.bind_message)
 
+        # Upload the textures of the next stimulus while the fixation
+        # point is displayed
+        self.__prefetch_stimuli()
+        # Blur the maps of the next stimulus in the meantime too
+        self.__blur_stimuli()
+
         # Ready the change over in state
         schedule_once(self.__next_state, FIX_DUR)
 
@@ -267,6 +288,8 @@ class Viewer(Window):
 
         # Set current_img to the next stimulus image to be displayed
         self.current_img = self.stimulus.colormap[self.stimulus.current[0]]
+        # Select the mesh to be used for the next stimulus
+        self.render.select_stimuli(self.stimulus.current[0])
 
         # Set the shaders to be used, bind the VBO and assign current_img
         # as the texture
@@ -349,11 +372,78 @@ class Viewer(Window):
         self.run_state = self.states.pop(0)
         self.run_state()
 
+    def __prefetch_stimuli(self):
+        """
+        Decode the maps of the next stimulus and of the PREFETCH_DEPTH
+        stimuli after it in the background, then start uploading the
+        maps of the next stimulus
+        """
+        if self.prefetcher is None:
+            return
+
+        maps = [self.stimulus.colormap, self.stimulus.heightmap,
+                self.stimulus.normalmap]
+        # Only the colormap is used without the shaders
+        if not ENABLE_SHADER:
+            maps = maps[:1]
+
+        upcoming = [self.stimulus.current] + \
+            self.stimulus.upcoming(PREFETCH_DEPTH)
+        for stimuli in upcoming:
+            for loader in maps:
+                self.prefetcher.request([loader.sources[stimuli[0]]],
+                                        loader.load)
+
+        i = self.stimulus.current[0]
+        # Hand the maps decoded in the background to the stimuli, so that
+        # they are not loaded again
+        for loader in maps:
+            loader.put(i, self.prefetcher.take(loader.sources[i]))
+        images = self.__stimulus_maps(i)
+        if not ENABLE_SHADER:
+            images = images[:1]
+        self.render.prefetch_textures([image for image in images if
+                                       image is not None])
+
+    def __blur_stimuli(self):
+        """
+        Blur the maps of the next stimulus by the radius of the blur it
+        is to be presented with, see TRIAL_BLURS
+        """
+        if not ENABLE_SHADER or not self.render.gpu_blur:
+            return
+
+        i, radius = self.stimulus.current[0], self.stimulus.current[3]
+        colormap, heightmap, normalmap = self.__stimulus_maps(i)
+        self.render.blur_maps(heightmap, normalmap, radius)
+
+    def __stimulus_maps(self, i):
+        """
+        Get the colormap, heightmap and normalmap of the stimuli i, or
+        the colormap, the heightmap packed with the normalmap and None,
+        if the maps are packed
+
+        The heightmap and normalmap are those blurred on the CPU, if the
+        stimuli is blurred and the GPU does not blur them
+        """
+        radius = self.stimulus.current[3]
+        if radius and not self.render.gpu_blur:
+            return [self.stimulus.colormap[i]] + \
+                self.stimulus.blurred_maps(i, radius, self.render.packed_maps)
+        if self.render.packed_maps:
+            return [self.stimulus.colormap[i], self.stimulus.packedmap[i],
+                    None]
+        return [self.stimulus.colormap[i], self.stimulus.heightmap[i],
+                self.stimulus.normalmap[i]]
+
     def __ready_texture(self, shader_use, bind_function):
         """
         Set the shader use, call the binding function for the Vertex
         Buffer Objects and assign the texture as necessary
         """
+        # The textures bound before can be deleted once they are replaced
+        self.render.texture_cache.release()
+
         # Set the use of the shaders
         self.__shader_use(shader_use)
 
@@ -362,19 +452,27 @@ class Viewer(Window):
 
         if ENABLE_SHADER:
             i = self.stimulus.current[0]
-            if shader_use:
-                textures = [self.current_img, self.stimulus.heightmap[i],
-                            self.stimulus.normalmap[i]]
+            # The maps of the stimuli are already bound as texture arrays
+            if shader_use and self.render.texture_arrays:
+                textures = []
+            # The heightmap and normalmap blurred on the GPU are already
+            # in the textures they were blurred into
+            elif shader_use and self.render.blur_radius:
+                textures = [self.current_img]
+            elif shader_use:
+                textures = [self.current_img] + \
+                    [image for image in self.__stimulus_maps(i)[1:] if
+                     image is not None]
             else:
                 textures = [self.current_img]
             for img in textures:
                 # Assign the texture
-                self.render.assign_texture(img, img.width, img.height)
+                self.render.assign_texture(img, img.shape[1], img.shape[0])
         else:
             # Assign the texture
             self.render.assign_texture(self.current_img,
-                                       self.current_img.width,
-                                       self.current_img.height)
+                                       self.current_img.shape[1],
+                                       self.current_img.shape[0])
 
 # ------------------------------------------------------------------
 # HANDLE SHADER USE
@@ -393,11 +491,11 @@ class Viewer(Window):
         # If the shader is enabled, pass values to the shader
         if ENABLE_SHADER:
             i = self.stimulus.current[0]
+            colormap, heightmap, normalmap = self.__stimulus_maps(i)
             # Pass stimuli colormap and heightmap to shaders
             self.render.pass_to_shaders(self.render.shader, use,
-                                        self.current_img,
-                                        self.stimulus.heightmap[i],
-                                        self.stimulus.normalmap[i])
+                                        self.current_img, heightmap,
+                                        normalmap)
 
 # ------------------------------------------------------------------
 # HANDLE RENDERING
@@ -442,6 +540,7 @@ class Viewer(Window):
                 compiled_data[count]['image'] = data[0]
                 compiled_data[count]['height_ratio'] = data[1]
                 compiled_data[count]['slant'] = data[2]
+                compiled_data[count]['blur'] = data[3]
                 compiled_data[count]['rt'] = self.reaction_times[count]
                 compiled_data[count]['answer'] = self.slants[count]
             else:
@@ -0,0 +1,235 @@
+from multiprocessing import Pool
+
+from numpy import (
+                   arange, clip, exp, float32, inf, log, maximum, minimum,
+                   rint, roll, sqrt, uint8, where, zeros
+)
+from numpy.random import RandomState
+
+from time import time
+
+from cache import AssetCache
+from mipmaps import cache_mipmapped
+from normalmaps import build_normalmap
+from settings import (
+                      NORMALMAP_RATIO, VORONOI_CELLS, VORONOI_GAP,
+                      VORONOI_GREY, VORONOI_JITTER, VORONOI_ROUNDING,
+                      VORONOI_STIMULI, VORONOI_WORKERS,
+                      WIDTH, HEIGHT
+)
+from tools import get_time
+
+
+# Offsets of the cells of the grid searched for the seeds nearest to a
+# pixel, from the cell the pixel is in. As each seed lies within its
+# own cell, the seeds 3 or more cells away are further than any seed
+# of its own cell, so the 5 x 5 cells around it always hold the nearest
+NEIGHBOURS = [(i, j) for i in range(-2, 3) for j in range(-2, 3)]
+
+# Exponent of the profile of the dome of each cell, rising steeply from
+# the gaps and flattening towards its top
+DOME_EXPONENT = 0.4
+
+
+# ------------------------------------------------------------------
+# HANDLE VORONOI DIAGRAMS
+# ------------------------------------------------------------------
+
+def voronoi_cells(seeds, width, height, rounding=VORONOI_ROUNDING):
+    """
+    Find the Voronoi cell of each pixel of an image of width and height,
+    along with its distance to the edge of the cell
+
+    seeds holds the position of the seed of each cell of a grid over the
+    image, as the fraction of the grid cell it lies at. The image wraps
+    around as the textures repeat, so the cells along its edges carry on
+    from the other edge
+
+    Rather than a tree of the seeds, the jittered grid itself is used to
+    look up the seeds nearest to each pixel, those of the cells around
+    it, so every pixel is handled at once
+
+    The distance to the edge is the distance to the nearest bisector
+    between the seed of the cell and the other seeds, taken as a soft
+    minimum over rounding pixels so that the corners are rounded
+
+    >>> from numpy import array
+    >>> seeds = array([[[0.5, 0.5], [0.5, 0.5]], [[0.5, 0.5], [0.5, 0.5]]])
+    >>> labels, edges = voronoi_cells(seeds, 4, 4, 0.001)
+    >>> labels.tolist()
+    [[0, 0, 1, 1], [0, 0, 1, 1], [2, 2, 3, 3], [2, 2, 3, 3]]
+    >>> edges[0].round(2).tolist()
+    [0.5, 0.5, 0.5, 0.5]
+    """
+    cells = seeds.shape[0]
+    size_y, size_x = height / float(cells), width / float(cells)
+    # Center of each pixel, and the cell of the grid it is in
+    y = (arange(height, dtype=float32) + 0.5)[:, None]
+    x = (arange(width, dtype=float32) + 0.5)[None, :]
+    row = (y[:, 0] // size_y).astype(int)
+    col = (x[0] // size_x).astype(int)
+    # The cells as floats, so that the positions are kept in float32
+    rows, cols = row.astype(float32)[:, None], col.astype(float32)[None, :]
+    grid = arange(cells * cells).reshape(cells, cells)
+
+    # Position of the seed of each neighbouring cell, moved across the
+    # image for the cells wrapped around, and its squared distance
+    seed_y, seed_x, distance, label = [], [], [], []
+    for i, j in NEIGHBOURS:
+        # The seeds and labels of the cells i down and j across, spread
+        # over the pixels of each cell with take as it only copies rows
+        # and columns
+        shifted = roll(roll(seeds, -i, axis=0), -j, axis=1).astype(float32)
+        shifted = shifted.take(row, axis=0).take(col, axis=1)
+        seed_y.append((rows + i + shifted[..., 0]) * size_y)
+        seed_x.append((cols + j + shifted[..., 1]) * size_x)
+        distance.append((y - seed_y[-1]) ** 2 + (x - seed_x[-1]) ** 2)
+        labels = roll(roll(grid, -i, axis=0), -j, axis=1)
+        label.append(labels.take(row, axis=0).take(col, axis=1))
+
+    # Find the nearest of the seeds
+    nearest = distance[0]
+    near_y, near_x, labels = seed_y[0], seed_x[0], label[0]
+    for k in range(1, len(NEIGHBOURS)):
+        closer = distance[k] < nearest
+        nearest = where(closer, distance[k], nearest)
+        near_y = where(closer, seed_y[k], near_y)
+        near_x = where(closer, seed_x[k], near_x)
+        labels = where(closer, label[k], labels)
+
+    bisectors = []
+    for k in range(len(NEIGHBOURS)):
+        apart = sqrt((seed_y[k] - near_y) ** 2 + (seed_x[k] - near_x) ** 2)
+        bisector = (distance[k] - nearest) / (2 * maximum(apart, 1e-6))
+        # The nearest seed itself has no bisector with itself
+        bisectors.append(where(apart > 0, bisector, inf))
+
+    # Take the soft minimum relative to the nearest bisector, so that the
+    # exponentials of the others never underflow to nothing
+    edges = reduce(minimum, bisectors)
+    total = zeros((height, width), float32)
+    for bisector in bisectors:
+        total += exp((edges - bisector) / rounding)
+    return labels, edges - rounding * log(total)
+
+
+def generate(seed, width=WIDTH, height=HEIGHT):
+    """
+    Generate the colormap, heightmap and normalmap of the Voronoi
+    stimulus of seed, as arrays as loaded by tools.load_pixels
+
+    Each cell of the heightmap is a dome rising from the gaps between the
+    cells to its highest at the point furthest from its edges, where the
+    colormap is noise about VORONOI_GREY. The normalmap is built from the
+    heightmap, so the three maps always match
+
+    >>> colormap, heightmap, normalmap = generate(0, 64, 64)
+    >>> colormap.shape, heightmap.dtype.name, normalmap.shape
+    ((64, 64), 'uint8', (64, 64, 3))
+    >>> (colormap == 0).tolist() == (heightmap == 0).tolist()
+    True
+    >>> (generate(0, 64, 64)[0] == colormap).all()
+    True
+    """
+    random = RandomState(seed)
+    jitter = random.uniform(size=(VORONOI_CELLS, VORONOI_CELLS, 2))
+    seeds = 0.5 + (jitter - 0.5) * VORONOI_JITTER
+    labels, edges = voronoi_cells(seeds, width, height)
+
+    # Distance of the pixels within the cells from the gaps, scaled so
+    # that the dome of each cell reaches the top of the heightmap
+    inside = edges - VORONOI_GAP / 2.0
+    peaks = zeros(VORONOI_CELLS * VORONOI_CELLS)
+    maximum.at(peaks, labels, inside)
+    dome = clip(inside / maximum(peaks[labels], 1e-6), 0.0, 1.0)
+    heightmap = rint(dome ** DOME_EXPONENT * 255).astype(uint8)
+
+    mean, deviation = VORONOI_GREY
+    grey = random.normal(mean, deviation, size=(height, width))
+    colormap = where(heightmap > 0, rint(clip(grey, 1, 255)), 0)
+    colormap = colormap.astype(uint8)
+
+    return colormap, heightmap, build_normalmap(heightmap, NORMALMAP_RATIO)
+
+
+# ------------------------------------------------------------------
+# HANDLE ASSET CACHE
+# ------------------------------------------------------------------
+
+def stimulus_key(seed):
+    """
+    Get the key in the asset cache of the stimulus of seed, made from
+    all the settings it is generated with
+    """
+    return AssetCache('voronoi').key(seed, WIDTH, HEIGHT, VORONOI_CELLS,
+                                     VORONOI_JITTER, VORONOI_GAP,
+                                     VORONOI_ROUNDING, VORONOI_GREY,
+                                     DOME_EXPONENT, NORMALMAP_RATIO)
+
+
+def cache_stimulus(seed):
+    """
+    Generate the stimulus of seed into the asset cache, unless it is
+    there already, returning its key
+    """
+    load_voronoi(seed)
+    return stimulus_key(seed)
+
+
+def load_voronoi(seed):
+    """
+    Load the colormap, heightmap and normalmap of the stimulus of seed,
+    memory-mapped from the asset cache, or otherwise generate them and
+    store them into the cache
+    """
+    cache = AssetCache('voronoi')
+    key = stimulus_key(seed)
+    arrays = cache.load(key)
+    if arrays is None:
+        maps = generate(seed)
+        cache.save(key, dict(zip(['colormap', 'heightmap', 'normalmap'],
+                                 maps)))
+        return maps
+    return arrays['colormap'], arrays['heightmap'], arrays['normalmap']
+
+
+def load_voronoi_map(source):
+    """
+    Load a single map of the stimulus for source, the seed of the
+    stimulus and the position of the map, 0 for the colormap, 1 for the
+    heightmap and 2 for the normalmap
+
+    Only the asset cache is shared, so the maps can be loaded from any
+    thread
+    """
+    seed, position = source
+    return load_voronoi(seed)[position]
+
+
+def load_voronoi_mipmapped(seed):
+    """
+    Load the colormap of the stimulus of seed along with its mip chain,
+    cached under the key of the stimulus
+    """
+    return cache_mipmapped(stimulus_key(seed), load_voronoi_map, (seed, 0))
+
+
+def generate_all(seeds, workers=VORONOI_WORKERS):
+    """
+    Generate the stimuli of all the seeds into the asset cache, across a
+    pool of processes each writing its stimuli straight into the cache,
+    returning their keys
+    """
+    pool = Pool(max(1, min(workers, len(seeds))))
+    try:
+        return pool.map(cache_stimulus, seeds)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    t0 = time()
+    generate_all(range(VORONOI_STIMULI))
+    print 'Generating %d stimuli took %s seconds' % \
+        (VORONOI_STIMULI, get_time(t0, time()))